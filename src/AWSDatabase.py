@@ -1,9 +1,17 @@
-from json import load,dump
 import csv
+from bisect import bisect_left, bisect_right
+from sys import intern
 from os.path import join,isfile
-from typing import Union, List, Dict, Tuple
-import requests
-from bs4 import BeautifulSoup
+from threading import Lock, RLock
+from typing import Callable, Union, Iterable, List, Dict, Mapping, Set, Tuple
+from scraper import Scraper, BadAmazonProductException, ScrapeFailedException, AmazonBlockedException
+from pageState import PageStateStore
+from scrapeCache import ScrapeCache
+from scrapeEngine import ScrapeEngine, CycleSummary, JobCancelledException, shardOf
+from updateJob import UpdateJob
+from storage import Storage, openStorage
+from pollScheduler import PollScheduler
+from amazonUrl import AsinIndex, extractAsin, canonicalUrl, isShortLink
 
 ##?## ----------------------------------- Exceptions --------------------------------------- ##?##
 
@@ -36,10 +44,6 @@ class EmptyWatchlistException(Exception):
     """Exception raised when the watchlist has no products
     """
     pass
-class BadAmazonProductException(Exception):
-    """Exception raised when an Amazon product's page is not fit to be scraped
-    """
-    pass
 
 
 
@@ -92,24 +96,42 @@ class AWSDatabase:
 
         class Product:
 
+            __slots__ = ("url","asin","name","fullName","lastPrice","price")
+
+            scraper:Scraper = Scraper()
+
             url:str
+            asin:Union[str,None]
             name:Union[str,None]
             fullName:str
             lastPrice:Union[float,None]
             price:float
 
-            def __init__(self, url:str, name:str=None, d:dict=None) -> None:
+            def __init__(self, url:str, name:str=None, d:dict=None, asinIndex:AsinIndex=None) -> None:
                 self.url = None
+                self.asin = None
                 self.name = None
                 self.fullName = None
                 self.lastPrice = None
                 self.price = None
-                if (len(url) > 0): self.url = url
+                if (len(url) > 0): self.url = intern(url)
                 else: return
-                if (url.startswith("https://")): self.webScrape()
-                if ((name is not None) and (len(name) > 0)): self.name = name
+                if (url.startswith("https://")):
+                    asin,canonical = (asinIndex if asinIndex is not None else AsinIndex()).canonicalize(url)
+                    self.asin,self.url = (None if asin is None else intern(asin)),intern(canonical)
+                    self.webScrape()
+                if ((name is not None) and (len(name) > 0)): self.name = intern(name)
                 if (d is not None): self.fromDict(d)
 
+            @property
+            def key(self) -> str:
+                # the canonical URL: the same ASIN is a different listing (price, currency) on every marketplace
+                return self.url
+
+            @property
+            def displayName(self) -> str:
+                return self.name if (self.name is not None) else self.fullName
+
             def __str__(self) -> str:
                 return f"{self.name if (self.name is not None) else self.fullName}: {self.price:.2f} €"
             def __repr__(self) -> str:
@@ -129,35 +151,22 @@ class AWSDatabase:
                 return False
 
 
-            def webScrape(self, max_retries:int=20) -> None:
-                fullName = None
-                price = None
-                
-                for _ in range(max_retries):
-                    if ((price is not None) and (fullName is not None)): break
-
-                    r = requests.get(self.url)
-                    if (r.status_code != 200): continue
-                    
-                    pageContent = BeautifulSoup(r.content, 'html.parser')
-
-                    try:
-                        whole_price = pageContent.find("span",class_="a-price-whole")
-                        cent_price = pageContent.find("span",class_="a-price-fraction")
-                        price_str = f"{whole_price.text.replace(',','.')}{cent_price.text}"
-                        price = float(price_str)
-                    except: raise BadAmazonProductException
+            def webScrape(self, max_retries:int=None) -> None:
+                fullName,price = self.scraper.scrape(self.url,self.key,max_retries=max_retries)
+                self.setScraped(fullName,price)
 
-                    if (fullName is None): fullName = pageContent.find("span",id="productTitle").text.strip()
-
-                if (self.fullName is None): self.fullName = fullName
+            def setScraped(self, fullName:Union[str,None], price:Union[float,None]) -> None:
+                if ((self.fullName is None) and (fullName is not None)): self.fullName = intern(fullName)
                 self.lastPrice = self.price
                 self.price = price
-                return
 
 
             def updatePrice(self) -> float:
                 self.webScrape()
+                return self.priceDiff()
+
+            def priceDiff(self) -> float:
+                if (self.lastPrice is None): return 0.0
                 return self.lastPrice - self.price
 
             
@@ -166,6 +175,7 @@ class AWSDatabase:
                     "name":self.name,
                     "fullName":self.fullName,
                     "url":self.url,
+                    "asin":self.asin,
                     "lastPrice":self.lastPrice,
                     "price":self.price
                 }
@@ -173,8 +183,12 @@ class AWSDatabase:
 
             def fromDict(self, d:dict) -> None:
                 self.url = d['url']
-                self.name = d['name']
-                self.fullName = d['fullName']
+                self.asin = d.get('asin',None)
+                if ((self.asin is None) and (not isShortLink(self.url))): self.asin = extractAsin(self.url)
+                if (self.asin is not None): self.url,self.asin = intern(canonicalUrl(self.url,self.asin)),intern(self.asin)
+                else: self.url = intern(self.url)
+                self.name = None if d['name'] is None else intern(d['name'])
+                self.fullName = None if d['fullName'] is None else intern(d['fullName'])
                 self.lastPrice = d['lastPrice']
                 self.price = d['price']
 
@@ -182,19 +196,29 @@ class AWSDatabase:
 
 
 
+        __slots__ = ("name","products","targetPrice","lastTotal","total","pendingDiff","_keys","_byName","_byUrl")
+
         name:str
         products:List[Product]
+        _keys:List[str]
+        _byName:Dict[str,Union[Product,Tuple[Product,...]]]
+        _byUrl:Dict[str,Union[Product,Tuple[Product,...]]]
         targetPrice:Union[float,None]
         lastTotal:Union[float,None]
         total:float
+        pendingDiff:float
 
         def __init__(self, name:str, targetPrice:float=None, d:dict=None) -> None:
             if (not (len(name) > 0)): return
             self.name = name
             self.products = []
+            self._keys = []
+            self._byName = {}
+            self._byUrl = {}
             self.targetPrice = targetPrice
             self.lastTotal = None
             self.total = 0.0
+            self.pendingDiff = 0.0
             if (d is not None):
                 self.fromDict(d)
 
@@ -217,7 +241,8 @@ class AWSDatabase:
                 "products":[],
                 "targetPrice":self.targetPrice,
                 "lastTotal":self.lastTotal,
-                "total":self.total
+                "total":self.total,
+                "pendingDiff":self.pendingDiff
             }
             for prod in self.products:
                 out_d["products"].append(prod.toDict())
@@ -228,70 +253,113 @@ class AWSDatabase:
             self.targetPrice = d['targetPrice']
             self.lastTotal = d['lastTotal']
             self.total = d['total']
+            self.pendingDiff = d.get('pendingDiff',0.0)
             for prod_d in d['products']:
-                new_prod = self.Product("fakeurl",d=prod_d)
-                self.products.append(new_prod)
-            self.products.sort(key=lambda p: p.name if p.name is not None else p.fullName)
+                self._index(self.Product("fakeurl",d=prod_d))
 
         
         def editTargetPrice(self, targetPrice:Union[float,None]) -> None:
             self.targetPrice = targetPrice
 
 
-        def addProduct(self, url:str, name:str=None) -> str:
+        def addProduct(self, url:str, name:str=None, asinIndex:AsinIndex=None) -> str:
             #if (self.findProduct(name) is not None): return -1
-            try: new_prod = self.Product(url,name)
+            try: new_prod = self.Product(url,name,asinIndex=asinIndex)
+            except ScrapeFailedException: raise
             except: raise BadAmazonProductException
+            return self.insertProduct(new_prod)
+
+        def insertProduct(self, new_prod:Product) -> str:
             self.total += new_prod.price
-            self.products.append(new_prod)
-            self.products.sort(key=lambda p: p.name if p.name is not None else p.fullName)
-            return new_prod.name if new_prod.name is not None else new_prod.fullName
+            self._index(new_prod)
+            return new_prod.displayName
         
-        def removeProduct(self, name:str) -> int:
-            index = self.findProduct(name)
-            if (index is not None):
-                popped = self.products.pop(index)
-                self.total -= popped.price
-                self.products.sort(key=lambda p: p.name if p.name is not None else p.fullName)
+        def removeProduct(self, name:str, url:str=None) -> int:
+            """Removes the product named name (the one with the given url, if there are more with the same name)"""
+            for prod in self._lookup(self._byName,name):
+                if ((url is not None) and (prod.url != url)): continue
+                self._unindex(prod)
+                self.total -= prod.price
                 return 0
             return -1
         
 
-        def findProduct(self, name:str) -> Union[int,None]:
-            top = len(self.products)-1
-            bot = 0     
-            while (top >= bot):
-                mid = (top+bot)//2
-                elem = self.products[mid]
-                elem_name = elem.name if elem.name is not None else elem.fullName
-                if (name == elem_name):
-                    return mid
-                if (name < elem_name):
-                    top = (mid-1)
-                    continue
-                if (name > elem_name):
-                    bot = (mid+1)
-                    continue
-            return None
-
-        #! DEPRECATED, LINEAR TIME :(
-        def findProductLinear(self, name:str) -> int:
-            for index,prod in enumerate(self.products):
-                if (name == (prod.name if prod.name is not None else prod.fullName)):
-                    return index
-            return None
+        def findProduct(self, name:str) -> Union[Product,None]:
+            """Returns the first product named name, None if there is none"""
+            prods = self._lookup(self._byName,name)
+            return prods[0] if (len(prods) > 0) else None
+
+        def findProductsByUrl(self, url:str) -> List[Product]:
+            """Returns the products with the given (canonical) url"""
+            return list(self._lookup(self._byUrl,url))
+
+        def _index(self, prod:Product) -> None:
+            # products stays sorted by name: the position is found by bisection on the parallel list of names
+            # (equal names keep their insertion order), the dictionaries give the products by name and by url
+            key = prod.displayName
+            i = bisect_right(self._keys,key)
+            self._keys.insert(i,key)
+            self.products.insert(i,prod)
+            for index,index_key in [(self._byName,key),(self._byUrl,prod.url)]:
+                index[index_key] = self._lookup(index,index_key)+(prod,)
+                if (len(index[index_key]) == 1): index[index_key] = prod
+
+        def _unindex(self, prod:Product) -> None:
+            key = prod.displayName
+            for i in range(bisect_left(self._keys,key),bisect_right(self._keys,key)):
+                if (self.products[i] is prod):
+                    del self._keys[i]
+                    del self.products[i]
+                    break
+            for index,index_key in [(self._byName,key),(self._byUrl,prod.url)]:
+                prods = tuple(other for other in self._lookup(index,index_key) if other is not prod)
+                if (len(prods) == 0): del index[index_key]
+                else: index[index_key] = prods if (len(prods) > 1) else prods[0]
+
+        @staticmethod
+        def _lookup(index:dict, key:str) -> tuple:
+            # the indexes hold the product itself, or a tuple when more products share the key
+            prods = index.get(key,())
+            return prods if isinstance(prods,tuple) else (prods,)
 
 
         def updatePrices(self) -> bool:
             if (len(self.products) == 0): return False
-            diff = 0.0
             for i in range(len(self.products)):
-                diff += self.products[i].updatePrice()
+                self.products[i].webScrape()
+            return self.updateTotal()
+
+        def updateTotal(self, defer:bool=False, onChange:bool=False, scraped:Set[str]=None) -> bool:
+            """Updates the total with the prices of products that have just been scraped (the ones whose key
+            is in scraped, every product if None), returns True if the watchlist is worth notifying (see isWorthNotifying for onChange).
+            If defer is True the difference is added to pendingDiff and notified later by consumePending
+            """
+            if (len(self.products) == 0): return False
+            diff = 0.0
+            for prod in self.products:
+                if ((prod.lastPrice is not None) and ((scraped is None) or (prod.url in scraped))): diff += prod.lastPrice - prod.price
             self.lastTotal = self.total
             self.total -= diff
+            if (defer):
+                self.pendingDiff += diff
+                return False
+            return self.isWorthNotifying(diff,onChange)
+
+        def consumePending(self) -> bool:
+            """Returns True if the differences accumulated by the deferred updates are worth notifying, and resets them"""
+            if (len(self.products) == 0): return False
+            diff,self.pendingDiff = self.pendingDiff,0.0
+            return self.isWorthNotifying(diff)
+
+        def isWorthNotifying(self, diff:float, onChange:bool=False) -> bool:
+            """Returns True if the total dropped by at least 5 or is below the target price.
+            If onChange is True a total below the target counts only if it just crossed it or it changed,
+            so that frequent checks don't repeat the same notification
+            """
             if (self.targetPrice is not None):
                 if (self.total <= self.targetPrice):
-                    return True
+                    if (not onChange): return True
+                    if ((self.total+diff > self.targetPrice) or (round(diff,2) != 0.0)): return True
             if (diff >= 5.0):
                 return True
             return False
@@ -302,20 +370,38 @@ class AWSDatabase:
 
 
     jsonPath:str
+    sqlitePath:str
+    asinPath:str
+    pageStatesPath:str
+    pollPath:str
+    jobPath:str
     csvPath:str
     pendingPath:str
     banPath:str
     adminId:int
     authorizedUsers:List[int]
     bannedUsers:List[int]
-    database:Dict[int,Dict[str,dict]]
-
-    def __init__(self, adminId:int, resourcesPath:str) -> None:
+    database:Mapping[int,Dict[str,dict]]
+    users:Dict[int,Dict[str,Watchlist]]
+    storage:Storage
+    asinIndex:AsinIndex
+    scraper:Scraper
+    scrapeEngine:ScrapeEngine
+    pollScheduler:PollScheduler
+    updateJob:UpdateJob
+    lastCycleSummary:Union[CycleSummary,None]
+
+    def __init__(self, adminId:int, resourcesPath:str, scrapeWorkers:int=8, storageBackend:str="json", flushDelay:float=0.0) -> None:
         self.jsonPath = join(resourcesPath,"database.json")
+        self.sqlitePath = join(resourcesPath,"database.sqlite3")
+        self.asinPath = join(resourcesPath,"asin_index.json")
+        self.pageStatesPath = join(resourcesPath,"page_states.json")
+        self.pollPath = join(resourcesPath,"poll_schedule.json")
+        self.jobPath = join(resourcesPath,"update_job.json")
         self.csvPath = join(resourcesPath,"authorized_users.csv")
         self.pendingPath = join(resourcesPath,"pending_users.txt")
         self.banPath = join(resourcesPath,"banned_users.txt")
-        if (not isfile(self.jsonPath)): self.createJsonFile()
+        if ((storageBackend == "json") and (not isfile(self.jsonPath))): self.createJsonFile()
         if (not isfile(self.csvPath)): self.createCsvFile()
         if (not isfile(self.pendingPath)): self.createPendingFile()
         if (not isfile(self.banPath)): self.createBanFile()
@@ -323,10 +409,23 @@ class AWSDatabase:
         self.authorizedUsers = []
         self.bannedUsers = []
         self.database = {}
+        self.users = {}
+        self._lock = RLock()
+        self._cycleLock = Lock()
+        self.storage = openStorage(storageBackend,self.jsonPath,self.sqlitePath,flushDelay)
+        self.asinIndex = AsinIndex(self.asinPath)
+        self.scraper = Scraper(
+            pageStates=PageStateStore(self.pageStatesPath),
+            cache=ScrapeCache(negativeExceptions=(BadAmazonProductException,))
+        )
+        self.Watchlist.Product.scraper = self.scraper
+        self.asinIndex.resolver = self.scraper.resolveShortLink
+        self.scrapeEngine = ScrapeEngine(scrapeWorkers)
+        self.pollScheduler = PollScheduler(self.pollPath)
+        self.updateJob = UpdateJob(self.jobPath)
+        self.lastCycleSummary = None
         self.loadDb()
-        if (self.adminId not in self.database.keys()):
-            self.database[self.adminId] = dict()
-            self.saveDb()
+        if (self.adminId not in self.database.keys()): self.storage.addUser(self.adminId)
 
 
     def createJsonFile(self) -> None:
@@ -414,27 +513,48 @@ class AWSDatabase:
         0 if successful, -1 if there's already a database entry for user_id (anomaly)
         """
 
-        if (user_id in self.database.keys()): return -1
-        self.addAuthUser(user_id,user_firstName)
-        self.database[user_id] = dict()
-        self.saveDb()
+        with self._lock:
+            if (user_id in self.database.keys()): return -1
+            self.addAuthUser(user_id,user_firstName)
+            self.storage.addUser(user_id)
+            self.users[user_id] = {}
         return 0
         
     def banUser(self, user_id:int) -> int:
         if (user_id in self.bannedUsers): return -1
         self.removeAuthUser(user_id)
-        try: self.database.pop(user_id)
-        except KeyError as kErr: pass
+        with self._lock:
+            if (user_id in self.database): self.storage.removeUser(user_id)
+            self.users.pop(user_id,None)
         self.bannedUsers.append(user_id)
         with open(self.banPath,"w",encoding='utf-8') as ban_file:
             for u_id in self.bannedUsers: ban_file.write(str(u_id)+'\n')
-        self.saveDb()
         return 0
             
     
     def getUser(self, user_id:int) -> Dict[str,dict]:
         return self.database.get(user_id,None)
 
+    def getUserWatchlists(self, user_id:int) -> Union[Dict[str,Watchlist],None]:
+        """Returns the live watchlists of the user (built from the database the first time they're needed
+        and then kept up to date in place), None if the user is not present in the database"""
+        with self._lock:
+            wls = self.users.get(user_id,None)
+            if (wls is None):
+                user_dict = self.getUser(user_id)
+                if (user_dict is None): return None
+                wls = self.users[user_id] = {wl_name:self.Watchlist(wl_name,d=wl_dict) for wl_name,wl_dict in user_dict.items()}
+                # entries saved before the URLs were canonicalized are rewritten once, so that the stored
+                # products match the live ones (removeProduct finds the stored entry by url and name)
+                if (any(self.isLegacyWatchlist(wl_dict,wls[wl_name]) for wl_name,wl_dict in user_dict.items())):
+                    self.storage.updateUsers({user_id:{wl_name:wl.toDict() for wl_name,wl in wls.items()}})
+            return wls
+
+    @staticmethod
+    def isLegacyWatchlist(wl_dict:dict, wl:Watchlist) -> bool:
+        stored = sorted((prod_d["url"],prod_d.get("asin",None)) for prod_d in wl_dict["products"])
+        return stored != sorted((prod.url,prod.asin) for prod in wl.products)
+
 
     
     def getWatchlists(self, user_id:int) -> List[str]:
@@ -450,9 +570,9 @@ class AWSDatabase:
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        ret = [wl_name for wl_name in user_dict.keys()]
+        wls = self.getUserWatchlists(user_id)
+        if (wls is None): raise UserNotFoundError
+        ret = list(wls.keys())
         if (len(ret) == 0): raise EmptyProfileException
         return ret
 
@@ -471,11 +591,10 @@ class AWSDatabase:
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        wl_dict = user_dict.get(wl_name,None)
-        if (wl_dict is None): raise WatchlistNotFoundException
-        wl = self.Watchlist(wl_name,d=wl_dict)
+        wls = self.getUserWatchlists(user_id)
+        if (wls is None): raise UserNotFoundError
+        wl = wls.get(wl_name,None)
+        if (wl is None): raise WatchlistNotFoundException
         ret = [prod.name if prod.name is not None else prod.fullName for prod in wl.products]
         if (len(ret) == 0): raise EmptyWatchlistException
         return ret
@@ -506,12 +625,12 @@ class AWSDatabase:
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        if (wl_name in user_dict.keys()): raise WatchlistDuplicateException
-        user_dict[wl_name] = self.Watchlist(wl_name,targetPrice).toDict()
-        self.database[user_id] = user_dict
-        self.saveDb()
+        with self._lock:
+            wls = self.getUserWatchlists(user_id)
+            if (wls is None): raise UserNotFoundError
+            if (wl_name in wls): raise WatchlistDuplicateException
+            wl = wls[wl_name] = self.Watchlist(wl_name,targetPrice)
+            self.storage.addWatchlist(user_id,wl_name,wl.toDict())
         return 0
 
 
@@ -537,12 +656,11 @@ class AWSDatabase:
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        popped = user_dict.pop(wl_name,None)
-        if (popped is None): raise WatchlistNotFoundException
-        self.database[user_id] = user_dict
-        self.saveDb()
+        with self._lock:
+            wls = self.getUserWatchlists(user_id)
+            if (wls is None): raise UserNotFoundError
+            if (wls.pop(wl_name,None) is None): raise WatchlistNotFoundException
+            self.storage.removeWatchlist(user_id,wl_name)
         return 0
 
     
@@ -571,19 +689,26 @@ class AWSDatabase:
 
         Raises
         -----
-        UserNotAuthorizedException, UserNotFoundError, WatchlistNotFoundException, BadAmazonProductException
+        UserNotAuthorizedException, UserNotFoundError, WatchlistNotFoundException, BadAmazonProductException, AmazonBlockedException
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        wl_dict = user_dict.get(wl_name,None)
-        if (wl_dict is None): raise WatchlistNotFoundException
-        wl = self.Watchlist(wl_name,d=wl_dict)
-        try: ret_name = wl.addProduct(url,prod_name)
-        except BadAmazonProductException: raise BadAmazonProductException
-        self.database[user_id][wl_name] = wl.toDict()
-        self.saveDb()
+        wls = self.getUserWatchlists(user_id)
+        if (wls is None): raise UserNotFoundError
+        if (wl_name not in wls): raise WatchlistNotFoundException
+        # the product is scraped before taking the lock, the other commands don't wait for Amazon
+        try: new_prod = self.Watchlist.Product(url,prod_name,asinIndex=self.asinIndex)
+        except ScrapeFailedException: raise
+        except: raise BadAmazonProductException
+        self.scraper.pageStates.saveStates()
+        with self._lock:
+            # the live watchlists may have been rebuilt (loadDb) or removed while the product was scraped
+            wls = self.getUserWatchlists(user_id)
+            if (wls is None): raise UserNotFoundError
+            wl = wls.get(wl_name,None)
+            if (wl is None): raise WatchlistNotFoundException
+            ret_name = wl.insertProduct(new_prod)
+            self.storage.addProduct(user_id,wl_name,new_prod.toDict(),wl.total)
         return ret_name
 
 
@@ -612,25 +737,30 @@ class AWSDatabase:
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        wl_dict = user_dict.get(wl_name,None)
-        if (wl_dict is None): raise WatchlistNotFoundException
-        wl = self.Watchlist(wl_name,d=wl_dict)
-        if (wl.removeProduct(prod_name) == -1): raise ProductNotFoundException
-        self.database[user_id][wl_name] = wl.toDict()
-        self.saveDb()
+        with self._lock:
+            wls = self.getUserWatchlists(user_id)
+            if (wls is None): raise UserNotFoundError
+            wl = wls.get(wl_name,None)
+            if (wl is None): raise WatchlistNotFoundException
+            prod = wl.findProduct(prod_name)
+            if (prod is None): raise ProductNotFoundException
+            popped = prod.toDict()
+            wl.removeProduct(prod_name,prod.url)
+            self.storage.removeProduct(user_id,wl_name,popped,wl.total)
         return 0
 
 
 
-    def updateWatchlists(self, user_id:int) -> str:
+    def updateWatchlists(self, user_id:int, onWatchlist:Callable[[int,Watchlist,bool],None]=None) -> str:
         """Updates all the user watchlists and returns an update message
 
         Parameters
         -----
         user_id : int
             The unique Telegram user ID
+
+        onWatchlist : Callable[[int,Watchlist,bool],None] (optional)
+            Called as soon as each watchlist is updated (see updateAllWatchlists)
         
         Returns
         -----
@@ -642,22 +772,227 @@ class AWSDatabase:
         UserNotAuthorizedException, UserNotFoundError
         """
 
-        self.loadDb()
-        if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
-        ret = "Some of your watchlists have been updated!\n\n"
-        for wl_name in user_dict.keys():
-            wl = self.Watchlist(wl_name,d=user_dict[wl_name])
-            if (wl.updatePrices()):
-                ret += str(wl) + "\n ~~~~~ \n"
-            user_dict[wl_name] = wl.toDict()
-        if (ret == "Some of your watchlists have been updated!\n\n"): ret = ""
-        self.database[user_id] = user_dict
-        self.saveDb()
+        ret = self.updateAllWatchlists([user_id],onWatchlist=onWatchlist)[user_id]
+        if (isinstance(ret,Exception)): raise ret
         return ret
 
 
+
+    def updateAllWatchlists(self, user_ids:List[int], dueOnly:bool=False, shard:Tuple[int,int]=None, notify:bool=True,
+                            job:UpdateJob=None, onWatchlist:Callable[[int,Watchlist,bool],None]=None) -> Dict[int,Union[str,Exception]]:
+        """Updates the watchlists of every user in user_ids, scraping the products of all of them
+        concurrently with scrapeEngine, and saves once at the end the users that had a product scraped.
+        Every distinct product (by canonical URL, i.e. marketplace and ASIN) is scraped once and
+        its result is shared by all the entries referencing it, the cycle's counters are stored in
+        lastCycleSummary
+
+        Parameters
+        -----
+        user_ids : List[int]
+            The unique Telegram user IDs of the users to update
+
+        dueOnly : bool
+            If True only the products whose check is due according to pollScheduler (within its
+            hourly budget) are scraped, the others are left as they are
+
+        shard : Tuple[int,int] (optional)
+            (index, count): only the products whose key falls in shard index of count (see shardOf) are scraped
+
+        notify : bool
+            If False the differences are accumulated in the watchlists (see Watchlist.consumePending)
+            instead of being notified, and every message is empty
+
+        job : UpdateJob (optional)
+            The checkpoint of the cycle: the products it already holds aren't scraped again,
+            and every product scraped is checkpointed as soon as its result is known
+
+        onWatchlist : Callable[[int,Watchlist,bool],None] (optional)
+            Called with the user ID, the watchlist and whether it's worth notifying as soon as
+            all the products of a watchlist have been scraped (from the scraping threads),
+            so its result can be shown before the whole cycle is over
+
+        Returns
+        -----
+        Dict[int,Union[str,Exception]]
+            For each user, the update message to be sent to them or the exception that
+            prevented their update (UserNotAuthorizedException, UserNotFoundError or any
+            scraping error raised by one of their products)
+        """
+
+        # the live watchlists are updated in place, one cycle at a time
+        with self._cycleLock: return self._updateAllWatchlists(user_ids,dueOnly,shard,notify,job,onWatchlist)
+
+    def _updateAllWatchlists(self, user_ids:List[int], dueOnly:bool, shard:Union[Tuple[int,int],None], notify:bool,
+                             job:Union[UpdateJob,None], onWatchlist:Union[Callable[[int,Watchlist,bool],None],None]) -> Dict[int,Union[str,Exception]]:
+        results:Dict[int,Union[str,Exception]] = {}
+        user_wls:Dict[int,List[AWSDatabase.Watchlist]] = {}
+        with self._lock:
+            for user_id in user_ids:
+                if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)):
+                    results[user_id] = UserNotAuthorizedException()
+                    continue
+                wls = self.getUserWatchlists(user_id)
+                if (wls is None):
+                    results[user_id] = UserNotFoundError()
+                    continue
+                user_wls[user_id] = list(wls.values())
+
+        summary = CycleSummary()
+        key_prods:Dict[str,List[Tuple[int,AWSDatabase.Watchlist.Product]]] = {}
+        for user_id,wls in user_wls.items():
+            for wl in wls:
+                for prod in wl.products:
+                    if (prod.asin is not None): self.asinIndex.addAsin(prod.asin,prod.url,save=False)
+                    key_prods.setdefault(prod.key,[]).append((user_id,prod))
+                    summary.increment("products")
+        self.asinIndex.saveIndex()
+        keys = list(key_prods.keys())
+        selected = set(keys)
+        if (shard is not None): selected = {key for key in selected if shardOf(key,shard[1]) == shard[0]}
+        if (dueOnly):
+            due = set(self.pollScheduler.due(selected))
+            summary.increment("notDue",len(selected)-len(due))
+            selected = due
+        if (len(selected) == 0):
+            self.lastCycleSummary = summary
+            return {user_id:results.get(user_id,"") for user_id in user_ids}
+        keys = [key for key in keys if key in selected]
+        urls = [key_prods[key][0][1].url for key in keys]
+        deadline = self.scraper.retryPolicy.newCycleDeadline()
+        def scrapeJob(item:Tuple[str,str]) -> Tuple[str,float]:
+            key,url = item
+            checkpoint = job.getProduct(key) if job is not None else None
+            if (checkpoint is not None):
+                summary.increment("resumed")
+                if (isinstance(checkpoint,str)): raise BadAmazonProductException
+                return tuple(checkpoint)
+            try: outcome = self.scraper.scrape(url,key,summary,deadline=deadline)
+            except BadAmazonProductException:
+                if (job is not None): job.productDone(key,"BadAmazonProductException")
+                raise
+            if (job is not None): job.productDone(key,outcome)
+            return outcome
+        # every watchlist is completed as soon as the last of its products is scraped, not at the end of the cycle
+        remaining:Dict[int,int] = {}
+        key_wls:Dict[str,List[Tuple[int,AWSDatabase.Watchlist]]] = {}
+        worthy:Set[int] = set()
+        # only the users with a product scraped in this cycle are written back, the others didn't change
+        dirty:Set[int] = set()
+        for user_id,wls in user_wls.items():
+            for wl in wls:
+                wl_keys = {prod.key for prod in wl.products} & selected
+                remaining[id(wl)] = len(wl_keys)
+                for key in wl_keys: key_wls.setdefault(key,[]).append((user_id,wl))
+        def completeWatchlist(user_id:int, wl:AWSDatabase.Watchlist) -> bool:
+            # the total always follows the prices of the live products, even when the user's update failed;
+            # the checks of due products notify a watchlist only when its total changed or crossed the target
+            try: worth = wl.updateTotal(defer=(not notify),onChange=dueOnly,scraped=selected)
+            except Exception as e:
+                if (user_id not in results): results[user_id] = e
+                return False
+            if (worth): worthy.add(id(wl))
+            return user_id not in results
+        def applyOutcome(index:int, outcome:Union[Tuple[str,float],Exception]) -> None:
+            completed = []
+            with self._lock:
+                for user_id,prod in key_prods[keys[index]]:
+                    dirty.add(user_id)
+                    if (isinstance(outcome,(ScrapeFailedException,JobCancelledException))):
+                        # transient failure (robot check, throttling, timeouts, shutdown): keep the last known price
+                        prod.setScraped(prod.fullName,prod.price)
+                        summary.increment("keptStale")
+                        continue
+                    if (isinstance(outcome,Exception)):
+                        prod.setScraped(prod.fullName,prod.price)
+                        if (user_id not in results): results[user_id] = outcome
+                        continue
+                    prod.setScraped(*outcome)
+                for user_id,wl in key_wls.get(keys[index],[]):
+                    remaining[id(wl)] -= 1
+                    if ((remaining[id(wl)] == 0) and completeWatchlist(user_id,wl)): completed.append((user_id,wl))
+            if (onWatchlist is not None):
+                for user_id,wl in completed: onWatchlist(user_id,wl,id(wl) in worthy)
+        for user_id,wls in user_wls.items():
+            for wl in wls:
+                # a watchlist none of whose products is scraped in this cycle has nothing new to evaluate
+                if ((remaining[id(wl)] == 0) and (len(wl.products) > 0)): continue
+                with self._lock: completed = (remaining[id(wl)] == 0) and completeWatchlist(user_id,wl)
+                if (completed and (onWatchlist is not None)): onWatchlist(user_id,wl,id(wl) in worthy)
+        outcomes = self.scrapeEngine.run(scrapeJob,zip(keys,urls),applyOutcome)
+        self.scraper.pageStates.saveStates()
+        summary.increment("fetches",len(urls))
+        summary.increment("fetchesSaved",sum(len(key_prods[key]) for key in keys)-len(urls))
+        if (summary.get("pagesFetched") + summary.get("notModified") > 0):
+            summary.set("skipRatePercent",round(100*(summary.get("unchanged")+summary.get("notModified"))/(summary.get("pagesFetched")+summary.get("notModified"))))
+
+        for user_id,wls in user_wls.items():
+            if (user_id in results): continue
+            ret = "Some of your watchlists have been updated!\n\n"
+            for wl in wls:
+                if (id(wl) in worthy):
+                    ret += str(wl) + "\n ~~~~~ \n"
+            if (ret == "Some of your watchlists have been updated!\n\n"): ret = ""
+            results[user_id] = ret
+
+        urgencies:Dict[str,float] = {}
+        for wls in user_wls.values():
+            for wl in wls:
+                urgency = PollScheduler.urgencyOf(wl.total,wl.targetPrice)
+                for prod in wl.products:
+                    urgencies[prod.key] = max(urgencies.get(prod.key,0.0),urgency)
+        for key,outcome in zip(keys,outcomes):
+            if (isinstance(outcome,(ScrapeFailedException,JobCancelledException))): continue
+            self.pollScheduler.observe(key,(outcome[1] if not isinstance(outcome,Exception) else None),urgencies.get(key,0.0))
+        self.pollScheduler.saveStates()
+        if (len(dirty) > 0):
+            self.storage.updateUsers(self.serializeUsers(dirty))
+            self.storage.flush()
+        self.lastCycleSummary = summary
+        return results
+
+
+    
+    def notifyAll(self, user_ids:List[int], job:UpdateJob=None) -> Dict[int,Union[str,Exception]]:
+        """Builds the consolidated notification of every user in user_ids from the differences
+        accumulated by the deferred updates (updateAllWatchlists with notify=False), and resets them
+
+        Parameters
+        -----
+        user_ids : List[int]
+            The unique Telegram user IDs of the users to notify
+
+        job : UpdateJob (optional)
+            The checkpoint of the cycle, the messages are stored in it before the accumulated differences are reset on disk
+
+        Returns
+        -----
+        Dict[int,Union[str,Exception]]
+            For each user, the message to be sent to them ("" if nothing is worth notifying)
+            or the exception that prevented it (UserNotAuthorizedException, UserNotFoundError)
+        """
+
+        results:Dict[int,Union[str,Exception]] = {}
+        with self._cycleLock, self._lock:
+            for user_id in user_ids:
+                if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)):
+                    results[user_id] = UserNotAuthorizedException()
+                    continue
+                wls = self.getUserWatchlists(user_id)
+                if (wls is None):
+                    results[user_id] = UserNotFoundError()
+                    continue
+                ret = "Some of your watchlists have been updated!\n\n"
+                for wl in wls.values():
+                    if (wl.consumePending()):
+                        ret += str(wl) + "\n ~~~~~ \n"
+                if (ret == "Some of your watchlists have been updated!\n\n"): ret = ""
+                results[user_id] = ret
+            if (job is not None): job.setMessages({user_id:msg for user_id,msg in results.items() if isinstance(msg,str)})
+            self.storage.updateUsers(self.serializeUsers(user_id for user_id,msg in results.items() if isinstance(msg,str)))
+        self.storage.flush()
+        return results
+
+
     
     def toString(self, user_id:int) -> str:
         """Returns the string representation of all the user's watchlists
@@ -678,30 +1013,39 @@ class AWSDatabase:
         """
 
         if ((user_id not in self.authorizedUsers) and (user_id != self.adminId)): raise UserNotAuthorizedException
-        user_dict = self.getUser(user_id)
-        if (user_dict is None): raise UserNotFoundError
+        wls = self.getUserWatchlists(user_id)
+        if (wls is None): raise UserNotFoundError
         ret = ""
-        for wl_name,wl_dict in user_dict.items():
-            wl = self.Watchlist(wl_name,d=wl_dict)
+        for wl in list(wls.values()):
             ret += str(wl) + "\n ~~~~~ \n"
         if (ret == ""): raise EmptyProfileException
         return ret
 
 
 
+    def serializeUsers(self, user_ids:Iterable[int]) -> Dict[int,Dict[str,dict]]:
+        """Returns the database dictionaries of the live watchlists of the users (the ones still in the database)"""
+        with self._lock:
+            return {user_id:{wl_name:wl.toDict() for wl_name,wl in self.users[user_id].items()} for user_id in user_ids if user_id in self.users}
+
     def loadDb(self) -> None:
-        """Reads the database from the json file at jsonPath"""
-        tmp_d = {}
-        with open(self.jsonPath,"r",encoding='utf-8') as r_file:
-            tmp_d = load(r_file)
-        self.database = {int(k):v for k,v in tmp_d.items()}
+        """Reads the database from storage, the live watchlists are rebuilt the next time they're needed"""
+        with self._cycleLock, self._lock:
+            self.database = self.storage.load()
+            self.users = {}
+        self.refreshUsers()
+
+    def refreshUsers(self) -> None:
+        """Re-reads the authorized and banned users, leaving the live watchlists as they are"""
         self.authorizedUsers = self.readAuthUsersIds()
         self.bannedUsers = self.readBannedUsersIds()
         
 
     def saveDb(self) -> None:
-        """Writes the database to the json file at jsonPath"""
+        """Writes every user of the database to storage (the mutation methods already persist their own changes)"""
+        self.storage.updateUsers(dict(self.database))
+        self.storage.flush()
 
-        with open(self.jsonPath,"w",encoding='utf-8') as w_file:
-            dump(self.database,w_file,indent=4)
-            #TODO: rimuovere l'indent per la memoria
+    def flush(self) -> None:
+        """Persists right away the mutations still waiting in the storage debounce window"""
+        self.storage.flush()
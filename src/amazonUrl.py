@@ -0,0 +1,153 @@
+from json import load,dump
+from os.path import isfile
+import re
+from threading import Lock
+from typing import Callable, Dict, List, Tuple, Union
+from urllib.parse import urlsplit
+from httpSession import SESSION
+
+
+
+ASIN_PATTERNS = [
+    re.compile(r"/dp/([A-Z0-9]{10})(?:[/?#]|$)"),
+    re.compile(r"/gp/product/([A-Z0-9]{10})(?:[/?#]|$)"),
+    re.compile(r"/gp/aw/d/([A-Z0-9]{10})(?:[/?#]|$)"),
+    re.compile(r"/exec/obidos/ASIN/([A-Z0-9]{10})(?:[/?#]|$)"),
+    re.compile(r"/o/ASIN/([A-Z0-9]{10})(?:[/?#]|$)"),
+    re.compile(r"/product/([A-Z0-9]{10})(?:[/?#]|$)")
+]
+SHORT_LINK_HOSTS = ["amzn.eu","amzn.to","amzn.asia","a.co"]
+
+
+
+def extractAsin(url:str) -> Union[str,None]:
+    """Returns the ASIN contained in an Amazon product URL, None if there is none"""
+    path = urlsplit(url).path
+    for pattern in ASIN_PATTERNS:
+        match = pattern.search(path)
+        if (match is not None): return match.group(1)
+    return None
+
+def isShortLink(url:str) -> bool:
+    host = urlsplit(url).netloc.lower()
+    return (host in SHORT_LINK_HOSTS) or (host.startswith("www.") and host[4:] in SHORT_LINK_HOSTS)
+
+def canonicalUrl(url:str, asin:str) -> str:
+    """Returns the shortest URL of the product asin on the same Amazon marketplace of url"""
+    host = urlsplit(url).netloc.lower()
+    if (host.startswith("amazon.")): host = "www."+host
+    return f"https://{host}/dp/{asin}"
+
+
+
+class AsinIndex:
+    """Persistent index of the known products, keyed by ASIN. The same ASIN is a different
+    listing on every Amazon marketplace, so each ASIN maps to one canonical URL per marketplace
+
+    Attributes
+    -----
+    jsonPath : str
+        The filepath of the json file containing the index
+
+    asins : Dict[str,List[str]]
+        ASIN -> canonical URLs of the product, one per marketplace
+
+    shortLinks : Dict[str,str]
+        Short link (amzn.eu, amzn.to...) -> canonical URL it resolves to
+
+    resolver : Callable[[str],str]
+        Follows the redirects of a short link and returns the final URL (AWSDatabase uses
+        Scraper.resolveShortLink, with its timeouts, retries and throttle)
+
+    Methods
+    -----
+    canonicalize(url:str, resolve:bool=True) -> Tuple[Union[str,None],str]
+        Returns the (ASIN, canonical URL) of url, resolving short links only once
+
+    getUrls(asin:str) -> List[str]
+        Returns the canonical URLs of asin on the marketplaces where it's indexed
+    """
+
+    jsonPath:Union[str,None]
+    asins:Dict[str,List[str]]
+    shortLinks:Dict[str,str]
+    resolver:Callable[[str],str]
+
+    def __init__(self, jsonPath:str=None, resolver:Callable[[str],str]=None) -> None:
+        self.jsonPath = jsonPath
+        self.asins = {}
+        self.shortLinks = {}
+        self.resolver = resolver if resolver is not None else resolveShortLink
+        self._lock = Lock()
+        if ((jsonPath is not None) and isfile(jsonPath)): self.loadIndex()
+
+
+    def canonicalize(self, url:str, resolve:bool=True) -> Tuple[Union[str,None],str]:
+        """Returns the (ASIN, canonical URL) of an Amazon product URL
+
+        Parameters
+        -----
+        url : str
+            Any Amazon product URL (/dp/, /gp/product/, short link, with or without query string)
+
+        resolve : bool (optional)
+            Whether short links not yet indexed may be resolved with a network request
+
+        Returns
+        -----
+        Tuple[Union[str,None],str]
+            The ASIN (None if it can't be found) and the canonical URL (url itself if the ASIN can't be found)
+        """
+
+        url = url.strip()
+        if (isShortLink(url)):
+            with self._lock: resolved = self.shortLinks.get(url,None)
+            if (resolved is None):
+                if (not resolve): return None,url
+                resolved = self.resolver(url)
+                asin = extractAsin(resolved)
+                if (asin is None): return None,url
+                resolved = canonicalUrl(resolved,asin)
+                with self._lock: self.shortLinks[url] = resolved
+                self.addAsin(asin,resolved)
+            return extractAsin(resolved),resolved
+        asin = extractAsin(url)
+        if (asin is None): return None,url
+        canonical = canonicalUrl(url,asin)
+        self.addAsin(asin,canonical)
+        return asin,canonical
+
+
+    def addAsin(self, asin:str, url:str, save:bool=True) -> None:
+        with self._lock:
+            urls = self.asins.setdefault(asin,[])
+            if (url in urls): return
+            urls.append(url)
+        if (save): self.saveIndex()
+
+    def getUrls(self, asin:str) -> List[str]:
+        with self._lock: return list(self.asins.get(asin,[]))
+
+
+    def loadIndex(self) -> None:
+        """Reads the index from the json file at jsonPath"""
+        with open(self.jsonPath,"r",encoding='utf-8') as r_file:
+            tmp_d = load(r_file)
+        with self._lock:
+            # indexes written before the marketplaces were told apart map every ASIN to a single URL
+            self.asins = {asin:([urls] if isinstance(urls,str) else urls) for asin,urls in tmp_d.get("asins",{}).items()}
+            self.shortLinks = tmp_d.get("shortLinks",{})
+
+    def saveIndex(self) -> None:
+        """Writes the index to the json file at jsonPath"""
+        if (self.jsonPath is None): return
+        with self._lock:
+            with open(self.jsonPath,"w",encoding='utf-8') as w_file:
+                dump({"asins":self.asins,"shortLinks":self.shortLinks},w_file)
+
+
+
+def resolveShortLink(url:str, timeout:Tuple[float,float]=(5.0,15.0)) -> str:
+    """Follows the redirects of an Amazon short link and returns the final URL (a single request, see Scraper.resolveShortLink)"""
+    r = SESSION.head(url,allow_redirects=True,timeout=timeout)
+    return r.url
@@ -0,0 +1,191 @@
+from threading import Condition, Lock
+from time import monotonic
+from typing import Dict
+from urllib.parse import urlsplit
+
+
+
+def hostKey(url:str) -> str:
+    """Returns the domain a request to url is throttled under (amazon.it, amazon.de, amzn.eu...)"""
+    host = urlsplit(url).netloc.lower()
+    if (host.startswith("www.")): host = host[4:]
+    return host
+
+
+
+class HostState:
+    """Token bucket and adaptive concurrency limit of a single host"""
+
+    def __init__(self, rate:float, burst:float, maxConcurrency:int) -> None:
+        self.rate = rate
+        self.tokens = burst
+        self.lastRefill = monotonic()
+        self.limit = float(maxConcurrency)
+        self.inFlight = 0
+        self.errorRate = 0.0
+        self.latency = None
+        self.lastDecrease = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self.blocked = 0
+        self.consecutiveBlocks = 0
+        self.cooldownUntil = 0.0
+        self.cond = Condition()
+
+
+
+class HostThrottle:
+    """Per-host throttle of the scraper: a token bucket limits the request rate of every domain
+    and an AIMD (additive increase, multiplicative decrease) limit caps its concurrent requests.
+    Both back off when the host answers with throttling statuses, errors or slow responses
+    and slowly recover when it's healthy again
+
+    Attributes
+    -----
+    maxRate : float
+        Maximum requests per second for each host
+
+    minRate : float
+        Minimum requests per second the rate can back off to
+
+    burst : float
+        Maximum number of tokens (requests that can be sent at once) of each bucket
+
+    maxConcurrency : int
+        Maximum concurrent requests for each host
+
+    latencyTarget : float
+        Seconds of latency above which a host is considered overloaded
+
+    errorThreshold : float
+        Error rate (moving average, 0-1) above which a host is considered overloaded
+
+    cooldownBase : float
+        Seconds a host is left alone after a robot check or soft-block (503) page,
+        doubled at every consecutive block up to cooldownMax
+
+    Methods
+    -----
+    acquire(url:str, deadline:float) -> bool
+        Waits for a request slot of url's host, returns False if the deadline passes first
+
+    release(url:str, outcome:str, latency:float) -> None
+        Frees the slot taken by acquire, outcome is "ok", "throttled" (429), "blocked" (robot check or 503)
+        or "error". A "blocked" outcome also puts the host in cooldown
+
+    cancel(url:str) -> None
+        Frees the slot taken by acquire when no request has been sent
+
+    getStats() -> Dict[str,Dict[str,float]]
+        Returns the current state of every host
+    """
+
+    maxRate:float
+    minRate:float
+    burst:float
+    maxConcurrency:int
+    latencyTarget:float
+    errorThreshold:float
+    cooldownBase:float
+    cooldownMax:float
+    hosts:Dict[str,HostState]
+
+    def __init__(self, maxRate:float=2.0, burst:float=4.0, maxConcurrency:int=8, latencyTarget:float=3.0,
+                 errorThreshold:float=0.3, minRate:float=0.1, cooldownBase:float=30.0, cooldownMax:float=600.0) -> None:
+        self.maxRate = maxRate
+        self.minRate = minRate
+        self.burst = burst
+        self.maxConcurrency = max(1,maxConcurrency)
+        self.latencyTarget = latencyTarget
+        self.errorThreshold = errorThreshold
+        self.cooldownBase = cooldownBase
+        self.cooldownMax = cooldownMax
+        self.hosts = {}
+        self._lock = Lock()
+
+
+    def getHost(self, url:str) -> HostState:
+        key = hostKey(url)
+        with self._lock:
+            state = self.hosts.get(key,None)
+            if (state is None):
+                state = HostState(self.maxRate,self.burst,self.maxConcurrency)
+                self.hosts[key] = state
+        return state
+
+
+    def acquire(self, url:str, deadline:float) -> bool:
+        state = self.getHost(url)
+        with state.cond:
+            while True:
+                now = monotonic()
+                state.tokens = min(self.burst,state.tokens + (now-state.lastRefill)*state.rate)
+                state.lastRefill = now
+                if ((now >= state.cooldownUntil) and (state.inFlight < max(1,int(state.limit))) and (state.tokens >= 1)):
+                    state.tokens -= 1
+                    state.inFlight += 1
+                    state.requests += 1
+                    return True
+                remaining = deadline - now
+                if (remaining <= 0): return False
+                wait = remaining
+                if (now < state.cooldownUntil): wait = min(wait,state.cooldownUntil-now)
+                elif (state.tokens < 1): wait = min(wait,(1-state.tokens)/state.rate)
+                state.cond.wait(wait)
+
+
+    def release(self, url:str, outcome:str, latency:float) -> None:
+        state = self.getHost(url)
+        with state.cond:
+            state.inFlight -= 1
+            state.errorRate = 0.8*state.errorRate + (0.2 if outcome != "ok" else 0.0)
+            if (outcome == "ok"): state.latency = latency if state.latency is None else 0.8*state.latency + 0.2*latency
+            if (outcome == "throttled"): state.throttled += 1
+            if (outcome == "blocked"):
+                state.blocked += 1
+                state.consecutiveBlocks += 1
+                cooldown = min(self.cooldownMax,self.cooldownBase*(2**(state.consecutiveBlocks-1)))
+                state.cooldownUntil = max(state.cooldownUntil,monotonic()+cooldown)
+            elif (outcome == "ok"): state.consecutiveBlocks = 0
+            overloaded = (
+                (outcome in ["throttled","blocked"]) or
+                (state.errorRate > self.errorThreshold) or
+                ((state.latency is not None) and (state.latency > self.latencyTarget))
+            )
+            now = monotonic()
+            if (overloaded):
+                if (now - state.lastDecrease >= self.latencyTarget):
+                    state.limit = max(1.0,state.limit/2)
+                    state.rate = max(self.minRate,state.rate/2)
+                    state.lastDecrease = now
+            else:
+                state.limit = min(float(self.maxConcurrency),state.limit + 1/state.limit)
+                state.rate = min(self.maxRate,state.rate + self.maxRate*0.05)
+            state.cond.notify_all()
+
+
+    def cancel(self, url:str) -> None:
+        state = self.getHost(url)
+        with state.cond:
+            state.inFlight -= 1
+            state.tokens = min(self.burst,state.tokens+1)
+            state.cond.notify_all()
+
+
+    def getStats(self) -> Dict[str,Dict[str,float]]:
+        with self._lock: hosts = dict(self.hosts)
+        out_d = {}
+        for key,state in hosts.items():
+            with state.cond:
+                out_d[key] = {
+                    "rate": round(state.rate,2),
+                    "limit": round(state.limit,2),
+                    "inFlight": state.inFlight,
+                    "errorRate": round(state.errorRate,2),
+                    "latency": round(state.latency,2) if state.latency is not None else None,
+                    "requests": state.requests,
+                    "throttled": state.throttled,
+                    "blocked": state.blocked,
+                    "cooldown": round(max(0.0,state.cooldownUntil-monotonic()),1)
+                }
+        return out_d
@@ -0,0 +1,185 @@
+from threading import Lock
+from time import time
+from typing import Callable, Dict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    try:
+        import brotlicffi
+        BROTLI_AVAILABLE = True
+    except ImportError:
+        BROTLI_AVAILABLE = False
+
+
+
+def countingPool(base:type, onNewConnection:Callable[[],None]) -> type:
+    """Returns a subclass of the urllib3 pool base that calls onNewConnection
+    every time a new connection (TCP+TLS handshake) is opened
+    """
+    class CountingPool(base):
+        def _new_conn(self):
+            onNewConnection()
+            return super()._new_conn()
+    return CountingPool
+
+
+class CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report every new connection to onNewConnection"""
+
+    def __init__(self, onNewConnection:Callable[[],None], **kwargs) -> None:
+        self.onNewConnection = onNewConnection
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args,**kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": countingPool(HTTPConnectionPool,self.onNewConnection),
+            "https": countingPool(HTTPSConnectionPool,self.onNewConnection)
+        }
+
+
+
+class HttpSession:
+    """Shared keep-alive HTTP transport used by every scraper of the bot
+
+    One requests.Session is shared by all the threads: urllib3 pools are thread-safe
+    and keep the connections to each host alive between requests, cookies persist
+    and compressed responses (gzip, deflate and brotli if installed) are negotiated
+
+    Attributes
+    -----
+    defaultPoolSize : int
+        The maximum number of kept-alive connections for each host
+
+    hostPoolSizes : Dict[str,int]
+        Per-host overrides of defaultPoolSize (e.g. {"www.amazon.it": 16})
+
+    Methods
+    -----
+    configure(defaultPoolSize:int=None, hostPoolSizes:Dict[str,int]=None) -> None
+        Changes the pool sizes, mounting a new adapter for every configured host
+
+    get(url:str, **kwargs) -> requests.Response
+        Performs a GET request through the shared session
+
+    getStream(url:str, feed:Callable[[bytes],bool], chunkSize:int=65536, **kwargs) -> requests.Response
+        Performs a streamed GET request, stopping the download as soon as feed returns True
+
+    head(url:str, **kwargs) -> requests.Response
+        Performs a HEAD request through the shared session
+
+    getStats() -> Dict[str,float]
+        Returns the transport counters (requests, handshakes, bytes on the wire and decoded, latency)
+    """
+
+    defaultPoolSize:int
+    hostPoolSizes:Dict[str,int]
+    session:requests.Session
+    stats:Dict[str,int]
+
+    def __init__(self, defaultPoolSize:int=10, hostPoolSizes:Dict[str,int]=None) -> None:
+        self._lock = Lock()
+        self.stats = {"requests":0,"handshakes":0,"wireBytes":0,"bodyBytes":0,"streamAborts":0,"milliseconds":0}
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Accept-Encoding": "gzip, deflate, br" if BROTLI_AVAILABLE else "gzip, deflate",
+            "Connection": "keep-alive"
+        })
+        self.defaultPoolSize = defaultPoolSize
+        self.hostPoolSizes = {}
+        self.configure(defaultPoolSize,hostPoolSizes)
+
+
+    def configure(self, defaultPoolSize:int=None, hostPoolSizes:Dict[str,int]=None) -> None:
+        if (defaultPoolSize is not None): self.defaultPoolSize = defaultPoolSize
+        if (hostPoolSizes is not None): self.hostPoolSizes = dict(hostPoolSizes)
+        for scheme in ["http://","https://"]:
+            self.session.mount(scheme,self.newAdapter(self.defaultPoolSize))
+        for host,poolSize in self.hostPoolSizes.items():
+            self.session.mount(f"https://{host}/",self.newAdapter(poolSize))
+
+    def newAdapter(self, poolSize:int) -> HTTPAdapter:
+        return CountingAdapter(self.countHandshake,pool_connections=poolSize,pool_maxsize=poolSize)
+
+
+    def countHandshake(self) -> None:
+        with self._lock: self.stats["handshakes"] += 1
+
+
+    def get(self, url:str, **kwargs) -> requests.Response:
+        start = time()
+        r = self.session.get(url,**kwargs)
+        if (not kwargs.get("stream",False)): self.countResponse(r,len(r.content),start)
+        return r
+
+    def getStream(self, url:str, feed:Callable[[bytes],bool], chunkSize:int=65536, **kwargs) -> requests.Response:
+        """Downloads the page at url chunk by chunk, passing every chunk to feed, and stops
+        the download as soon as feed returns True. The body is fed only for 200 responses
+
+        Returns
+        -----
+        requests.Response
+            The response, whose content must not be read (it has been consumed by feed)
+        """
+
+        start = time()
+        r = self.session.get(url,stream=True,**kwargs)
+        bodyBytes = 0
+        aborted = False
+        try:
+            if (r.status_code == 200):
+                for chunk in r.iter_content(chunk_size=chunkSize):
+                    bodyBytes += len(chunk)
+                    if (feed(chunk)):
+                        aborted = True
+                        break
+        finally:
+            self.countResponse(r,bodyBytes,start)
+            r.close()
+        if (aborted):
+            with self._lock: self.stats["streamAborts"] += 1
+        return r
+
+    def head(self, url:str, **kwargs) -> requests.Response:
+        r = self.session.head(url,**kwargs)
+        with self._lock: self.stats["requests"] += 1
+        return r
+
+    def countResponse(self, r:requests.Response, bodyBytes:int, start:float) -> None:
+        """Adds a response whose body has been read (entirely or not) to the counters"""
+        try: wireBytes = r.raw.tell()
+        except Exception: wireBytes = bodyBytes
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["wireBytes"] += wireBytes
+            self.stats["bodyBytes"] += bodyBytes
+            self.stats["milliseconds"] += int((time()-start)*1000)
+
+
+    def getStats(self) -> Dict[str,float]:
+        with self._lock: out_d = dict(self.stats)
+        n = max(1,out_d["requests"])
+        out_d["handshakesPerRequest"] = out_d["handshakes"]/n
+        out_d["wireBytesPerRequest"] = out_d["wireBytes"]/n
+        out_d["millisecondsPerRequest"] = out_d["milliseconds"]/n
+        return out_d
+
+
+
+def parseHostPoolSizes(s:str) -> Dict[str,int]:
+    """Parses a "host=size,host=size" string (as found in .env) into a dictionary"""
+    out_d = {}
+    for entry in s.split(','):
+        if ('=' not in entry): continue
+        host,size = entry.split('=',1)
+        out_d[host.strip()] = int(size.strip())
+    return out_d
+
+
+
+SESSION = HttpSession()
@@ -1,6 +1,6 @@
 from json import load,dump
 from typing import Union, List, Dict
-import requests
+from httpSession import SESSION
 from bs4 import BeautifulSoup
 from pysondb import db
 
@@ -53,7 +53,7 @@ class JsonDatabase:
                 for _ in range(max_retries):
                     if ((price is not None) and (fullName is not None)): break
 
-                    r = requests.get(self.url)
+                    r = SESSION.get(self.url)
                     if (r.status_code != 200): continue
                     
                     pageContent = BeautifulSoup(r.content, 'html.parser')
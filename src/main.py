@@ -1,11 +1,22 @@
-from AWSDatabase import AWSDatabase, UserNotAuthorizedException, UserNotFoundError, WatchlistNotFoundException, WatchlistDuplicateException, ProductNotFoundException, EmptyProfileException, EmptyWatchlistException, BadAmazonProductException
+from AWSDatabase import AWSDatabase, UserNotAuthorizedException, UserNotFoundError, WatchlistNotFoundException, WatchlistDuplicateException, ProductNotFoundException, EmptyProfileException, EmptyWatchlistException, BadAmazonProductException, AmazonBlockedException
+from httpSession import SESSION, parseHostPoolSizes
+from scrapeCache import ScrapeCache
+from retryPolicy import RetryPolicy
+from hostThrottle import HostThrottle
+from parsePool import ParsePool
+from pollScheduler import PollScheduler
+from priceExtractor import EXTRACTOR_CHAIN
 import logging
 from dotenv import load_dotenv
 from sys import argv
 from os import getenv,makedirs
 from os.path import isfile,isdir,dirname
 import schedule
-from time import sleep
+from time import perf_counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from signal import signal, SIGINT, SIGTERM
 import telebot
 import threading
 from typing import Tuple,List
@@ -19,12 +30,59 @@ from typing import Tuple,List
 load_dotenv()
 RESOURCES_PATH = "./resources/"
 SCHEDULED_TIME = "13:00"
+POLL_TICK = int(getenv("POLL_TICK",15))
+UPDATE_WINDOW = int(getenv("UPDATE_WINDOW",120))
+UPDATE_SHARDS = max(1,int(getenv("UPDATE_SHARDS",8)))
+UPDATE_MARGIN = 5
+UPDATE_DEADLINE = float(getenv("UPDATE_DEADLINE",20))
+PROGRESS_EDIT_INTERVAL = 1.0
+
+stopping = threading.Event()
+updateExecutor = ThreadPoolExecutor(max_workers=int(getenv("UPDATE_WORKERS",4)))
+updateStats = {"updates":0,"continued":0,"firstResults":deque(maxlen=256)}
+updateStatsLock = threading.Lock()
+
+# the parse workers are forked before telebot and the database start their threads
+parsePool = ParsePool(int(getenv("PARSE_WORKERS")) if getenv("PARSE_WORKERS","") != "" else None)
+if (isfile(".env") and (__name__ == "__main__")): parsePool.start()
 
 bot:telebot.TeleBot = telebot.TeleBot("faketoken")
 db:AWSDatabase
 if (isfile(".env")):
     bot = telebot.TeleBot(getenv("TOKEN"),disable_web_page_preview=True)
-    db = AWSDatabase(int(getenv("ADMIN_ID")),RESOURCES_PATH)
+    db = AWSDatabase(int(getenv("ADMIN_ID")),RESOURCES_PATH,int(getenv("SCRAPE_WORKERS",8)),getenv("STORAGE_BACKEND","json").lower(),float(getenv("STORAGE_FLUSH_DELAY",1)))
+    db.scraper.stream = (getenv("STREAM_SCRAPE","yes").lower() not in ["no","false","0"])
+    db.scraper.retryPolicy = RetryPolicy(
+        int(getenv("RETRY_MAX_ATTEMPTS",6)),
+        float(getenv("RETRY_CONNECT_TIMEOUT",5)),
+        float(getenv("RETRY_READ_TIMEOUT",15)),
+        float(getenv("RETRY_BACKOFF_BASE",1)),
+        float(getenv("RETRY_BACKOFF_MAX",30)),
+        float(getenv("RETRY_PRODUCT_DEADLINE",120)),
+        float(getenv("RETRY_CYCLE_DEADLINE",3600))
+    )
+    db.scraper.throttle = HostThrottle(
+        float(getenv("THROTTLE_RATE",2)),
+        float(getenv("THROTTLE_BURST",4)),
+        int(getenv("THROTTLE_MAX_CONCURRENCY",8)),
+        float(getenv("THROTTLE_LATENCY_TARGET",3)),
+        cooldownBase=float(getenv("THROTTLE_BLOCK_COOLDOWN",30)),
+        cooldownMax=float(getenv("THROTTLE_BLOCK_COOLDOWN_MAX",600))
+    )
+    db.scraper.cache = ScrapeCache(
+        float(getenv("SCRAPE_CACHE_TTL",600)),
+        float(getenv("SCRAPE_CACHE_NEGATIVE_TTL",300)),
+        int(getenv("SCRAPE_CACHE_SIZE",1024)),
+        (BadAmazonProductException,)
+    )
+    db.pollScheduler = PollScheduler(
+        db.pollPath,
+        float(getenv("POLL_MIN_INTERVAL",30))*60,
+        float(getenv("POLL_MAX_INTERVAL",24))*3600,
+        int(getenv("POLL_HOURLY_BUDGET",120))
+    )
+    db.scraper.parser = parsePool
+    SESSION.configure(int(getenv("HTTP_POOL_SIZE",10)),parseHostPoolSizes(getenv("HTTP_HOST_POOL_SIZES","")))
 
 
 
@@ -138,61 +196,156 @@ def firstRun() -> bool:
         flag = True
     if (not isfile(".env")):
         with open(".env","x",encoding='utf-8') as new_env:
-            new_env.write(f"TOKEN = \"\"\nADMIN_ID = \"\"")
+            new_env.write(
+                "TOKEN = \"\"\n"
+                "ADMIN_ID = \"\"\n"
+                "SCRAPE_WORKERS = \"8\"\n"
+                "# json, journal, sharded or sqlite. Every backend keeps the database in memory and has a single writer:\n"
+                "# never run two bots (or a bot and another script that writes) on the same resources folder\n"
+                "STORAGE_BACKEND = \"json\"\n"
+                "STORAGE_FLUSH_DELAY = \"1\"\n"
+                "HTTP_POOL_SIZE = \"10\"\n"
+                "HTTP_HOST_POOL_SIZES = \"\"\n"
+                "STREAM_SCRAPE = \"yes\"\n"
+                "PARSE_WORKERS = \"\"\n"
+                "SCRAPE_CACHE_TTL = \"600\"\n"
+                "SCRAPE_CACHE_NEGATIVE_TTL = \"300\"\n"
+                "SCRAPE_CACHE_SIZE = \"1024\"\n"
+                "RETRY_MAX_ATTEMPTS = \"6\"\n"
+                "RETRY_CONNECT_TIMEOUT = \"5\"\n"
+                "RETRY_READ_TIMEOUT = \"15\"\n"
+                "RETRY_BACKOFF_BASE = \"1\"\n"
+                "RETRY_BACKOFF_MAX = \"30\"\n"
+                "RETRY_PRODUCT_DEADLINE = \"120\"\n"
+                "RETRY_CYCLE_DEADLINE = \"3600\"\n"
+                "THROTTLE_RATE = \"2\"\n"
+                "THROTTLE_BURST = \"4\"\n"
+                "THROTTLE_MAX_CONCURRENCY = \"8\"\n"
+                "THROTTLE_LATENCY_TARGET = \"3\"\n"
+                "THROTTLE_BLOCK_COOLDOWN = \"30\"\n"
+                "THROTTLE_BLOCK_COOLDOWN_MAX = \"600\"\n"
+                "UPDATE_WINDOW = \"120\"\n"
+                "UPDATE_SHARDS = \"8\"\n"
+                "UPDATE_DEADLINE = \"20\"\n"
+                "UPDATE_WORKERS = \"4\"\n"
+                "POLL_TICK = \"15\"\n"
+                "POLL_MIN_INTERVAL = \"30\"\n"
+                "POLL_MAX_INTERVAL = \"24\"\n"
+                "POLL_HOURLY_BUDGET = \"120\"\n"
+            )
         flag = True
     return flag
 
 
 
-def dailyUpdate() -> None:
-    db.loadDb()
-
-    for user_id in db.authorizedUsers:
-        tmp_msg = bot.send_message(chat_id=user_id,text=f"Automatic daily update running...")
-        try:
-            msg = db.updateWatchlists(user_id)
-        except UserNotAuthorizedException:
+def cycleOf(now:datetime) -> str:
+    """Returns the cycle (the date of the notification it leads to) an update running at now belongs to"""
+    notify_at = now.replace(hour=int(SCHEDULED_TIME[:2]),minute=int(SCHEDULED_TIME[3:]),second=0,microsecond=0)
+    if (now > notify_at): notify_at += timedelta(days=1)
+    return notify_at.date().isoformat()
+
+
+def updateShard(shard:int, cycle:str=None) -> None:
+    """Scrapes one shard of the products of the daily update, persisting the results
+    without notifying them (see dailyNotify). Products and shards are checkpointed in db.updateJob.
+    Every product of the shard is scraped, whether it's due or not: db.pollScheduler only records the checks"""
+    if (db.scrapeEngine.isStopping()): return
+    job = db.updateJob
+    job.begin(cycle if cycle is not None else cycleOf(datetime.now()))
+    if (shard in job.shardsDone): return
+    db.refreshUsers()
+    user_ids = db.authorizedUsers + ([db.adminId] if db.adminId not in db.authorizedUsers else [])
+    db.updateAllWatchlists(user_ids,shard=(shard,UPDATE_SHARDS),notify=False,job=job)
+    if (not db.scrapeEngine.isStopping()): job.shardDone(shard)
+    print(f"~> Update shard {shard+1}/{UPDATE_SHARDS} summary:\n{db.lastCycleSummary}\n")
+    logger.info(f"Update shard {shard+1}/{UPDATE_SHARDS} summary:\n{db.lastCycleSummary}")
+
+
+def dailyNotify(cycle:str=None) -> None:
+    """Sends every user the consolidated result of the shards run since the last notification,
+    each user at most once per cycle even across restarts"""
+    job = db.updateJob
+    job.begin(cycle if cycle is not None else cycleOf(datetime.now()-timedelta(minutes=UPDATE_MARGIN)))
+    if (job.finished): return
+    db.refreshUsers()
+    user_ids = db.authorizedUsers + ([db.adminId] if db.adminId not in db.authorizedUsers else [])
+    results = {}
+    if (len(job.messages) == 0): results = db.notifyAll(user_ids,job)
+    for user_id in user_ids:
+        if (user_id in job.notifiedUsers): continue
+        msg = job.messages.get(str(user_id),results.get(user_id,None))
+        if (msg is None): continue
+        if (isinstance(msg,UserNotAuthorizedException)):
             userNotAuthorizedException_message(user_id)
-            return
-        except UserNotFoundError:
+        elif (isinstance(msg,UserNotFoundError)):
             userNotFoundError_message(user_id)
-            return
-        except:
+        elif (isinstance(msg,Exception)):
             unknownError_message(user_id)
-            return
-        bot.delete_message(chat_id=user_id,message_id=tmp_msg.id)
-        sent = bot.send_message(
-            chat_id=user_id,
-            text=(msg if msg != "" else "You have no updates"),
-            reply_markup=telebot.types.ReplyKeyboardRemove()
-        )
-        log(sent,logger)
-
-    tmp_msg = bot.send_message(chat_id=db.adminId,text=f"Automatic daily update running...")
-    try:
-        msg = db.updateWatchlists(db.adminId)
-    except UserNotAuthorizedException:
-        userNotAuthorizedException_message(db.adminId)
-        return
-    except UserNotFoundError:
-        userNotFoundError_message(db.adminId)
-        return
-    except:
-        unknownError_message(db.adminId)
-        return
-    bot.delete_message(chat_id=db.adminId,message_id=tmp_msg.id)
-    sent = bot.send_message(
-        chat_id=db.adminId,
-        text=(msg if msg != "" else "You have no updates"),
-        reply_markup=telebot.types.ReplyKeyboardRemove()
-    )
-    log(sent,logger)
+        else:
+            sent = bot.send_message(
+                chat_id=user_id,
+                text=(msg if msg != "" else "You have no updates"),
+                reply_markup=telebot.types.ReplyKeyboardRemove()
+            )
+            log(sent,logger)
+        job.userNotified(user_id)
+    job.finish()
+
+
+def resumeUpdate() -> None:
+    """Resumes the cycle interrupted by a crash or a restart: runs the shards whose time has passed
+    and, if the notification time has passed too, notifies the users that haven't been notified yet"""
+    job = db.updateJob
+    if ((job.cycle is None) or job.finished): return
+    now = datetime.now()
+    notify_at = datetime.fromisoformat(job.cycle).replace(hour=int(SCHEDULED_TIME[:2]),minute=int(SCHEDULED_TIME[3:]))
+    for shard,offset in enumerate(shardOffsets(UPDATE_WINDOW,UPDATE_SHARDS)):
+        if ((shard not in job.shardsDone) and (notify_at-timedelta(minutes=offset) <= now)):
+            print(f"~> Resuming update shard {shard+1}/{UPDATE_SHARDS} of cycle {job.cycle}")
+            logger.info(f"Resuming update shard {shard+1}/{UPDATE_SHARDS} of cycle {job.cycle}")
+            updateShard(shard,job.cycle)
+    if ((notify_at <= now) and (not db.scrapeEngine.isStopping())): dailyNotify(job.cycle)
+
+
+def shardOffsets(window:int, shards:int) -> List[int]:
+    """Returns how many minutes before SCHEDULED_TIME every shard starts, spread evenly over
+    the window minutes ending UPDATE_MARGIN minutes before it"""
+    return [UPDATE_MARGIN + window - (shard*window)//shards for shard in range(shards)]
+
+def shardTimes(scheduled_time:str, window:int, shards:int) -> List[str]:
+    """Returns the HH:MM start time of every shard (see shardOffsets)"""
+    end = int(scheduled_time[:2])*60 + int(scheduled_time[3:])
+    times = []
+    for offset in shardOffsets(window,shards):
+        minute = (end - offset) % (24*60)
+        times.append(f"{minute//60:02d}:{minute%60:02d}")
+    return times
+
+
+def pollUpdate() -> None:
+    """Checks the products that are due according to db.pollScheduler, accumulating the differences
+    in the watchlists like the shards do: they're notified only by the consolidated notification (see dailyNotify)"""
+    db.refreshUsers()
+    user_ids = db.authorizedUsers + ([db.adminId] if db.adminId not in db.authorizedUsers else [])
+    db.updateAllWatchlists(user_ids,dueOnly=True,notify=False)
+    logger.info(f"Poll update summary:\n{db.lastCycleSummary}")
 
 
 def updateRoutine() -> None:
-    while True:
+    resumeUpdate()
+    while (not stopping.is_set()):
         schedule.run_pending()
-        sleep(60)
+        stopping.wait(60)
+
+
+def shutdown(signum:int, frame) -> None:
+    """Graceful shutdown: stops accepting new work, the scrapes in flight are drained
+    and the state is persisted once bot.infinity_polling returns"""
+    print("~> Shutting down, draining the scrapes in flight...")
+    logger.info("Shutting down")
+    stopping.set()
+    db.scrapeEngine.stop()
+    bot.stop_polling()
 
 
 def isValidTime(t:str) -> bool:
@@ -217,6 +370,28 @@ def isAuthorizedUser(user_id:int) -> bool:
     )
 
 
+def recordUpdate() -> None:
+    with updateStatsLock: updateStats["updates"] += 1
+
+def recordFirstResult(seconds:float) -> None:
+    """Records the time between an /update and its first watchlist result"""
+    with updateStatsLock: updateStats["firstResults"].append(seconds)
+
+def recordContinued() -> None:
+    with updateStatsLock: updateStats["continued"] += 1
+
+def getUpdateStats() -> dict:
+    """Returns the /update counters and the time to first result (p50 and max of the last 256 updates, in seconds)"""
+    with updateStatsLock:
+        first_results = sorted(updateStats["firstResults"])
+        return {
+            "updates": updateStats["updates"],
+            "continuedInBackground": updateStats["continued"],
+            "firstResultP50": round(first_results[len(first_results)//2],2) if len(first_results) > 0 else None,
+            "firstResultMax": round(first_results[-1],2) if len(first_results) > 0 else None
+        }
+
+
 """
 #! DO NOT USE UNTIL AUX FUNCTIONS GET WRITTEN
 def rescheduleUpdate(scheduled_time:str,user_id:str) -> bool:
@@ -321,6 +496,16 @@ def badAmazonProductException_message(user_id:int, prod_name:str) -> None:
 
 
 
+def amazonBlockedException_message(user_id:int) -> None:
+    sent = bot.send_message(
+        chat_id=user_id,
+        text="Amazon is temporarily blocking the bot, try again later!",
+        reply_markup=telebot.types.ReplyKeyboardRemove()
+    )
+    log(sent,logger)
+
+
+
 ##?## ------------------------------ BOT ROUTES ------------------------------ ##?##
 
 
@@ -578,6 +763,9 @@ def addproduct_step_3(message:telebot.types.Message,args:Tuple[int,str,str]) ->
     except BadAmazonProductException:
         badAmazonProductException_message(sender_id,(prod_name if prod_name not in ["No","no"] else ""))
         return
+    except AmazonBlockedException:
+        amazonBlockedException_message(sender_id)
+        return
     except:
         unknownError_message(sender_id)
         return
@@ -742,26 +930,62 @@ def update(message:telebot.types.Message) -> None:
         return
     tmp_msg = bot.send_message(
         chat_id=sender_id,
-        text="Scraping Amazon's website... (could take a while)"
+        text="Scraping Amazon's website..."
     )
+    start = perf_counter()
+    recordUpdate()
+    lock = threading.Lock()
+    progress = {"lines":[],"continued":False,"lastEdit":0.0}
+
+    def editProgress(force:bool=False) -> None:
+        with lock:
+            if ((not force) and (perf_counter()-progress["lastEdit"] < PROGRESS_EDIT_INTERVAL)): return
+            progress["lastEdit"] = perf_counter()
+            text = "Scraping Amazon's website...\n\n" + "\n".join(progress["lines"])
+            if (progress["continued"]): text += "\n\nThe other products are still being updated, I'll send you the result as soon as it's ready"
+        try: bot.edit_message_text(text,chat_id=sender_id,message_id=tmp_msg.id)
+        except: pass
+
+    def onWatchlist(user_id:int, wl:AWSDatabase.Watchlist, worth:bool) -> None:
+        with lock:
+            if (len(progress["lines"]) == 0): recordFirstResult(perf_counter()-start)
+            progress["lines"].append(str(wl) if worth else f"{wl.name}: no updates\n")
+        editProgress()
+
+    def finish(future:Future) -> None:
+        try:
+            msg = future.result()
+        except UserNotAuthorizedException:
+            userNotAuthorizedException_message(sender_id)
+            return
+        except UserNotFoundError:
+            userNotFoundError_message(sender_id)
+            return
+        except:
+            unknownError_message(sender_id)
+            return
+        if (not progress["continued"]): bot.delete_message(chat_id=sender_id,message_id=tmp_msg.id)
+        sent = bot.send_message(
+            chat_id=sender_id,
+            text=(msg if msg != "" else "You have no updates"),
+            reply_markup=telebot.types.ReplyKeyboardRemove()
+        )
+        log(sent,logger)
+
+    future = updateExecutor.submit(db.updateWatchlists,sender_id,onWatchlist)
     try:
-        msg = db.updateWatchlists(sender_id)
-    except UserNotAuthorizedException:
-        userNotAuthorizedException_message(sender_id)
-        return
-    except UserNotFoundError:
-        userNotFoundError_message(sender_id)
+        future.result(timeout=UPDATE_DEADLINE)
+    except FutureTimeoutError:
+        # past the deadline the update goes on in the background and its result is sent as a follow-up,
+        # this handler thread is freed for the other users
+        with lock: progress["continued"] = True
+        recordContinued()
+        editProgress(force=True)
+        future.add_done_callback(finish)
         return
     except:
-        unknownError_message(sender_id)
-        return
-    bot.delete_message(chat_id=sender_id,message_id=tmp_msg.id)
-    sent = bot.send_message(
-        chat_id=sender_id,
-        text=(msg if msg != "" else "You have no updates"),
-        reply_markup=telebot.types.ReplyKeyboardRemove()
-    )
-    log(sent,logger)
+        pass
+    finish(future)
 
 
 
@@ -820,6 +1044,43 @@ def users(message:telebot.types.Message) -> None:
     log(sent,logger)
 
 
+#? STATS (ADMIN COMMAND ONLY)
+@bot.message_handler(commands=['stats'])
+def stats(message:telebot.types.Message) -> None:
+    if (message.from_user.is_bot): return
+    log(message,logger)
+    if (message.from_user.id != db.adminId): return
+    msg = "HTTP transport:\n"
+    for key,value in SESSION.getStats().items():
+        msg += f"{key}: {value:.2f}\n" if isinstance(value,float) else f"{key}: {value}\n"
+    msg += "\nRetries:\n"
+    for key,value in db.scraper.retryPolicy.getStats().items(): msg += f"{key}: {value}\n"
+    msg += "\nHost throttle:\n"
+    for host,host_stats in db.scraper.throttle.getStats().items():
+        msg += f"{host}: " + ", ".join(f"{key}={value}" for key,value in host_stats.items()) + "\n"
+    msg += "\nPolling schedule:\n"
+    for key,value in db.pollScheduler.getStats().items(): msg += f"{key}: {value}\n"
+    msg += "\nParse pool:\n"
+    for key,value in db.scraper.parser.getStats().items():
+        msg += f"{key}: {value:.2f}\n" if isinstance(value,float) else f"{key}: {value}\n"
+    msg += "\nExtraction strategies:\n"
+    for name,strategy_stats in EXTRACTOR_CHAIN.getStats().items():
+        msg += f"{name}: " + ", ".join(f"{key}={value}" for key,value in strategy_stats.items()) + "\n"
+    msg += "\nScrape cache:\n"
+    if (db.scraper.cache is not None):
+        for key,value in db.scraper.cache.getStats().items(): msg += f"{key}: {value}\n"
+    msg += "\nStorage:\n"
+    for key,value in db.storage.getStats().items(): msg += f"{key}: {value}\n"
+    msg += "\nInteractive updates:\n"
+    for key,value in getUpdateStats().items(): msg += f"{key}: {value}\n"
+    msg += f"\nLast update cycle:\n{db.lastCycleSummary if db.lastCycleSummary is not None else 'none yet'}\n"
+    sent = bot.send_message(
+        chat_id=db.adminId,
+        text=msg
+    )
+    log(sent,logger)
+
+
 #? BAN (ADMIN COMMAND ONLY)
 @bot.message_handler(commands=['ban'])
 def ban(message:telebot.types.Message) -> None:
@@ -884,15 +1145,31 @@ if (__name__ == "__main__"):
         if (isValidTime(argv[1])):
             SCHEDULED_TIME = argv[1]
 
-    schedule.every().day.at(SCHEDULED_TIME).do(dailyUpdate)
+    for shard,shard_time in enumerate(shardTimes(SCHEDULED_TIME,UPDATE_WINDOW,UPDATE_SHARDS)):
+        schedule.every().day.at(shard_time).do(updateShard,shard)
+    schedule.every().day.at(SCHEDULED_TIME).do(dailyNotify)
+    schedule.every(POLL_TICK).minutes.do(pollUpdate)
     dailyUpdateThread = threading.Thread(target=updateRoutine)
 
     print("Jaf's AWS (Amazon Web Scraper) Telegram bot started\n")
     logger.info("Jaf's AWS (Amazon Web Scraper) server started")
 
+    signal(SIGTERM,shutdown)
+    signal(SIGINT,shutdown)
     dailyUpdateThread.start()
     bot.infinity_polling()
 
+    stopping.set()
+    db.scrapeEngine.stop()
+    dailyUpdateThread.join()
+    updateExecutor.shutdown(wait=True)
+    db.scraper.parser.shutdown()
+    db.scraper.pageStates.saveStates()
+    db.pollScheduler.saveStates()
+    db.storage.close()
+    print("Jaf's AWS (Amazon Web Scraper) Telegram bot stopped\n")
+    logger.info("Jaf's AWS (Amazon Web Scraper) server stopped")
+
 
 
  
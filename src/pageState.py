@@ -0,0 +1,64 @@
+from json import load,dump
+from os.path import isfile
+from threading import Lock
+from typing import Dict, Union
+
+
+
+class PageStateStore:
+    """Persistent per-product state of the last scraped page, used to avoid
+    downloading or parsing again pages that haven't changed
+
+    Each state is a dictionary with the keys:
+    "etag", "lastModified" (the HTTP validators sent by Amazon, None if missing),
+    "fingerprint" (hash of the price and title regions of the page),
+    "fullName", "price" (the values extracted from that page),
+    "priceSource" (the extraction strategy that found the price: the page is known to be unchanged
+    by its fingerprint only if it's "spans", whose windows the fingerprint covers)
+
+    Attributes
+    -----
+    jsonPath : str
+        The filepath of the json file containing the states
+
+    states : Dict[str,dict]
+        Product key (canonical URL) -> state
+
+    Methods
+    -----
+    get(key:str) -> Union[dict,None]
+        Returns the state of the product key, None if it was never scraped
+
+    set(key:str, state:dict) -> None
+        Stores the state of the product key (in memory, see saveStates)
+    """
+
+    jsonPath:Union[str,None]
+    states:Dict[str,dict]
+
+    def __init__(self, jsonPath:str=None) -> None:
+        self.jsonPath = jsonPath
+        self.states = {}
+        self._lock = Lock()
+        if ((jsonPath is not None) and isfile(jsonPath)): self.loadStates()
+
+
+    def get(self, key:str) -> Union[dict,None]:
+        with self._lock: return self.states.get(key,None)
+
+    def set(self, key:str, state:dict) -> None:
+        with self._lock: self.states[key] = state
+
+
+    def loadStates(self) -> None:
+        """Reads the states from the json file at jsonPath"""
+        with open(self.jsonPath,"r",encoding='utf-8') as r_file:
+            tmp_d = load(r_file)
+        with self._lock: self.states = tmp_d
+
+    def saveStates(self) -> None:
+        """Writes the states to the json file at jsonPath"""
+        if (self.jsonPath is None): return
+        with self._lock:
+            with open(self.jsonPath,"w",encoding='utf-8') as w_file:
+                dump(self.states,w_file)
@@ -0,0 +1,99 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_all_start_methods, get_context
+from os import cpu_count
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Tuple, Union
+from priceExtractor import ExtractorChain, EXTRACTOR_CHAIN, runStrategies
+
+
+
+def warmUp() -> None:
+    pass
+
+
+
+class ParsePool:
+    """CPU-bound parse stage of the scraper, run in worker processes so that parsing doesn't hold
+    the GIL of the bot: the fetch threads only download the pages and hand their raw bytes over,
+    waiting for the result without blocking the message handlers
+
+    Attributes
+    -----
+    maxWorkers : int
+        Number of worker processes, 0 to parse in the calling thread
+
+    chain : ExtractorChain
+        The chain whose strategies (in their current order) run in the workers and whose stats
+        are updated with what the workers measured
+
+    Methods
+    -----
+    start() -> Union[ProcessPoolExecutor,None]
+        Creates the process pool and forks its workers if it's not running yet and returns it,
+        None if maxWorkers is 0. Call it before any other thread is started
+
+    parse(content:bytes, price:float=None, title:str=None, skip:Tuple[str,...]=()) -> Tuple[Union[float,None],Union[str,None],Union[str,None]]
+        Same as chain.extract, run by a worker process if the pool is running, in the calling thread otherwise
+
+    shutdown() -> None
+        Stops the worker processes
+
+    getStats() -> Dict[str,float]
+        Returns the parse counters (offloaded, inline, brokenPools, seconds)
+    """
+
+    maxWorkers:int
+    chain:ExtractorChain
+    stats:Dict[str,float]
+
+    def __init__(self, maxWorkers:int=None, chain:ExtractorChain=EXTRACTOR_CHAIN) -> None:
+        self.maxWorkers = max(0,maxWorkers if maxWorkers is not None else (cpu_count() or 1))
+        self.chain = chain
+        self.stats = {"offloaded":0,"inline":0,"brokenPools":0,"seconds":0.0}
+        self._executor = None
+        self._lock = Lock()
+
+
+    def start(self) -> Union[ProcessPoolExecutor,None]:
+        if (self.maxWorkers == 0): return None
+        with self._lock:
+            if (self._executor is None):
+                # forked workers only run runStrategies, so nothing of the bot is imported again in them.
+                # The executor forks them on its first submit: a no-op is submitted right away, so that
+                # they're forked here and not later from a scraping thread while other threads hold locks
+                context = get_context("fork") if ("fork" in get_all_start_methods()) else None
+                self._executor = ProcessPoolExecutor(max_workers=self.maxWorkers,mp_context=context)
+                self._executor.submit(warmUp).result()
+            return self._executor
+
+
+    def parse(self, content:bytes, price:float=None, title:str=None, skip:Tuple[str,...]=()) -> Tuple[Union[float,None],Union[str,None],Union[str,None]]:
+        start = perf_counter()
+        # a pool that isn't running (not started yet or broken) is not started from here, see start
+        with self._lock: executor = self._executor
+        offloaded = executor is not None
+        if (offloaded):
+            try: price,title,source,records = executor.submit(runStrategies,self.chain.getStrategies(),bytes(content),price,title,skip).result()
+            except BrokenProcessPool:
+                with self._lock:
+                    if (self._executor is executor): self._executor = None
+                    self.stats["brokenPools"] += 1
+                offloaded = False
+        if (not offloaded): price,title,source,records = runStrategies(self.chain.getStrategies(),content,price,title,skip)
+        self.chain.record(records)
+        with self._lock:
+            self.stats["offloaded" if offloaded else "inline"] += 1
+            self.stats["seconds"] += perf_counter()-start
+        return price,title,source
+
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor,self._executor = self._executor,None
+        if (executor is not None): executor.shutdown(wait=True)
+
+
+    def getStats(self) -> Dict[str,float]:
+        with self._lock: return dict(self.stats)
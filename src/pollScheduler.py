@@ -0,0 +1,151 @@
+from collections import deque
+from json import load,dump
+from os.path import isfile
+from threading import Lock
+from time import time
+from typing import Deque, Dict, Iterable, List, Union
+
+
+
+class PollScheduler:
+    """Persistent per-product polling schedule: every product gets its own next check time,
+    sooner for volatile products and for products whose watchlists are close to their target price,
+    later for the ones whose price doesn't move, within a global scrape budget per hour
+
+    Each state is a dictionary with the keys:
+    "nextCheck" (epoch seconds), "interval" (seconds), "baseInterval" (seconds, the interval before urgency),
+    "price" (the last price seen), "checks", "changes" (how many checks found a different price)
+
+    After a check the base interval is multiplied by CHANGED_FACTOR if the price changed, by
+    UNCHANGED_FACTOR otherwise (starting from INITIAL_INTERVAL, kept between minInterval and maxInterval),
+    then divided by up to 1+URGENCY_WEIGHT for the products whose watchlists are close to their target price
+
+    Attributes
+    -----
+    jsonPath : str
+        The filepath of the json file containing the states
+
+    minInterval : float
+        Seconds between two checks of the most volatile or urgent products
+
+    maxInterval : float
+        Seconds between two checks of the products whose price never moves
+
+    hourlyBudget : int
+        Maximum number of products checked in any hour
+
+    states : Dict[str,dict]
+        Product key (canonical URL) -> state
+
+    Methods
+    -----
+    due(keys:Iterable[str], now:float=None) -> List[str]
+        Returns the keys whose check is due, cut to the remaining budget: never checked ones first,
+        then the most overdue relative to their interval
+
+    observe(key:str, price:float, urgency:float=0.0, now:float=None) -> None
+        Records a check of key that found price and schedules the next one
+
+    remainingBudget(now:float=None) -> int
+        Returns how many products can still be checked in the current hour
+
+    urgencyOf(total:float, targetPrice:float) -> float
+        Returns how close a watchlist total is to its target price (0-1)
+
+    getStats() -> Dict[str,float]
+        Returns the number of products, how many are due, the checks of the last hour,
+        the remaining budget and the mean interval in hours
+    """
+
+    INITIAL_INTERVAL = 43200.0
+    CHANGED_FACTOR = 0.5
+    UNCHANGED_FACTOR = 1.5
+    URGENCY_WEIGHT = 3.0
+
+    jsonPath:Union[str,None]
+    minInterval:float
+    maxInterval:float
+    hourlyBudget:int
+    states:Dict[str,dict]
+
+    def __init__(self, jsonPath:str=None, minInterval:float=1800.0, maxInterval:float=259200.0, hourlyBudget:int=120) -> None:
+        self.jsonPath = jsonPath
+        self.minInterval = minInterval
+        self.maxInterval = max(minInterval,maxInterval)
+        self.hourlyBudget = hourlyBudget
+        self.states = {}
+        self._checks:Deque[float] = deque()
+        self._lock = Lock()
+        if ((jsonPath is not None) and isfile(jsonPath)): self.loadStates()
+
+
+    def due(self, keys:Iterable[str], now:float=None) -> List[str]:
+        if (now is None): now = time()
+        with self._lock:
+            due_keys = []
+            for key in set(keys):
+                state = self.states.get(key,None)
+                if (state is None): due_keys.append((float("inf"),key))
+                elif (state["nextCheck"] <= now): due_keys.append(((now-state["nextCheck"])/state["interval"],key))
+        due_keys.sort(reverse=True)
+        return [key for _,key in due_keys[:self.remainingBudget(now)]]
+
+    def observe(self, key:str, price:float, urgency:float=0.0, now:float=None) -> None:
+        if (now is None): now = time()
+        with self._lock:
+            self._checks.append(now)
+            state = self.states.setdefault(key,{"nextCheck":0.0,"interval":self.INITIAL_INTERVAL,"baseInterval":self.INITIAL_INTERVAL,"price":None,"checks":0,"changes":0})
+            state["checks"] += 1
+            if ((price is not None) and (state["price"] is not None)):
+                changed = price != state["price"]
+                if (changed): state["changes"] += 1
+                base = state["baseInterval"] * (self.CHANGED_FACTOR if changed else self.UNCHANGED_FACTOR)
+                state["baseInterval"] = min(self.maxInterval,max(self.minInterval,base))
+            if (price is not None): state["price"] = price
+            state["interval"] = max(self.minInterval,state["baseInterval"]/(1+self.URGENCY_WEIGHT*min(1.0,max(0.0,urgency))))
+            state["nextCheck"] = now + state["interval"]
+
+    def remainingBudget(self, now:float=None) -> int:
+        if (now is None): now = time()
+        with self._lock:
+            while ((len(self._checks) > 0) and (self._checks[0] <= now-3600)): self._checks.popleft()
+            return max(0,self.hourlyBudget-len(self._checks))
+
+
+    @staticmethod
+    def urgencyOf(total:float, targetPrice:Union[float,None]) -> float:
+        """1 when the total is within 2% above the target, going down to 0 at 20% above it.
+        A total already below the target keeps a medium urgency, to catch it going back up
+        """
+        if ((targetPrice is None) or (targetPrice <= 0) or (total is None)): return 0.0
+        gap = (total-targetPrice)/targetPrice
+        if (gap <= 0): return 0.5
+        return min(1.0,max(0.0,(0.2-gap)/0.18))
+
+
+    def loadStates(self) -> None:
+        """Reads the states from the json file at jsonPath"""
+        with open(self.jsonPath,"r",encoding='utf-8') as r_file:
+            tmp_d = load(r_file)
+        with self._lock: self.states = tmp_d
+
+    def saveStates(self) -> None:
+        """Writes the states to the json file at jsonPath"""
+        if (self.jsonPath is None): return
+        with self._lock:
+            with open(self.jsonPath,"w",encoding='utf-8') as w_file:
+                dump(self.states,w_file)
+
+    def getStats(self, now:float=None) -> Dict[str,float]:
+        if (now is None): now = time()
+        budget = self.remainingBudget(now)
+        with self._lock:
+            intervals = [state["interval"] for state in self.states.values()]
+            return {
+                "products": len(self.states),
+                "due": sum(1 for state in self.states.values() if state["nextCheck"] <= now),
+                "checksLastHour": len(self._checks),
+                "remainingBudget": budget,
+                "meanIntervalHours": round(sum(intervals)/len(intervals)/3600,2) if len(intervals) > 0 else None,
+                "changes": sum(state["changes"] for state in self.states.values())
+            }
@@ -0,0 +1,508 @@
+from hashlib import blake2b
+from html import unescape
+from json import loads
+import re
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple, Union
+from bs4 import BeautifulSoup
+
+
+
+SPAN_OPEN = re.compile(rb"<span\b([^>]*)>",re.IGNORECASE)
+SPAN_TAG = re.compile(rb"<(/?)span\b[^>]*?(/?)>",re.IGNORECASE)
+ATTRIBUTE = re.compile(rb"""([^\s=/]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""")
+COMMENT = re.compile(rb"<!--.*?-->",re.DOTALL)
+TAG = re.compile(rb"<[^>]*>")
+NON_DIGITS = re.compile(r"\D")
+PRICE_TEXT = re.compile(r"\d[\d.,\s\u00a0\u202f]*")
+JSON_LD = re.compile(rb"""<script\b[^>]*type\s*=\s*["']application/ld\+json["'][^>]*>(.*?)</script""",re.IGNORECASE|re.DOTALL)
+META_TAG = re.compile(rb"<meta\b([^>]*)>",re.IGNORECASE)
+META_PRICE_NAMES = [b"og:price:amount",b"product:price:amount",b"price"]
+CORE_PRICE = re.compile(rb'"priceAmount"\s*:\s*"?(\d+(?:\.\d+)?)')
+BUYBOX_PRICE = re.compile(
+    rb"""<[a-z]+\b[^>]*\bid\s*=\s*["'](?:price_inside_buybox|newBuyBoxPrice|priceblock_ourprice|priceblock_dealprice)["'][^>]*>([^<]*)<""",
+    re.IGNORECASE
+)
+FIELDS = [(b"class",b"a-price-whole"),(b"class",b"a-price-fraction"),(b"id",b"productTitle")]
+FINGERPRINT_FIELDS = [(b"id",b"productTitle"),(b"class",b"a-price-whole")]
+FINGERPRINT_WINDOW = 512
+BLOCK_MARKERS = [
+    b"/errors/validateCaptcha",
+    b"captchacharacters",
+    b"<title>Robot Check</title>",
+    b"<title dir=\"ltr\">Robot Check</title>",
+    b"api-services-support@amazon.com",
+    b"To discuss automated access to Amazon data"
+]
+BLOCK_SCAN_BYTES = 32768
+
+
+
+def getAttribute(attrs:bytes, name:bytes) -> Union[bytes,None]:
+    for match in ATTRIBUTE.finditer(attrs):
+        if (match.group(1).lower() == name):
+            return next(group for group in match.groups()[1:] if group is not None)
+    return None
+
+
+def insideRawText(content:bytes, pos:int) -> bool:
+    """Whether pos falls inside a <script> element or a comment, where html.parser sees no tags"""
+    for open_str,close_str in [(b"<script",b"</script"),(b"<!--",b"-->")]:
+        open_pos = content.rfind(open_str,0,pos)
+        if ((open_pos != -1) and (content.find(close_str,open_pos,pos) == -1)): return True
+    return False
+
+
+def findSpan(content:bytes, attr:bytes, value:bytes, start:int=0, end:int=None) -> Tuple[Union[int,None],int]:
+    """Looks for the first <span> whose attribute attr contains value (as a class token when attr is class)
+    between start and end
+
+    Returns
+    -----
+    Tuple[Union[int,None],int]
+        The position right after the span's opening tag (None if there's none yet) and the position
+        from which the search should be resumed once more content is available
+    """
+    if (end is None): end = len(content)
+    pos = start
+    while True:
+        i = content.find(value,pos,end)
+        if (i == -1): return None,max(start,end-len(value))
+        tag_start = content.rfind(b"<",0,i)
+        if (tag_start == -1):
+            pos = i+1
+            continue
+        if (content.find(b">",i,end) == -1): return None,i
+        pos = i+1
+        match = SPAN_OPEN.match(content,tag_start,end)
+        if ((match is None) or (match.end() <= i)): continue
+        attr_value = getAttribute(match.group(1),attr)
+        if (attr_value is None): continue
+        if (((attr == b"class") and (value in attr_value.split())) or (attr_value == value)):
+            if (not insideRawText(content,tag_start)): return match.end(),match.end()
+
+
+def spanText(content:bytes, start:int, end:int=None) -> Union[str,None]:
+    """Returns the text of the <span> element whose content begins at start,
+    like BeautifulSoup's Tag.text, None if the element is not closed before end
+    """
+    if (end is None): end = len(content)
+    depth = 1
+    for match in SPAN_TAG.finditer(content,start,end):
+        if (match.group(1) == b"/"): depth -= 1
+        elif (match.group(2) != b"/"): depth += 1
+        if (depth == 0):
+            inner = TAG.sub(b"",COMMENT.sub(b"",bytes(content[start:match.start()])))
+            return unescape(inner.decode('utf-8',errors='replace'))
+    return None
+
+
+def findSpanText(content:bytes, attr:bytes, value:bytes) -> Union[str,None]:
+    start,_ = findSpan(content,attr,value)
+    if (start is None): return None
+    return spanText(content,start)
+
+
+
+def extractFast(content:bytes) -> Tuple[Union[str,None],Union[str,None],Union[str,None]]:
+    """Scans the raw page for the three spans the scraper needs without building a tree
+
+    Returns
+    -----
+    Tuple[Union[str,None],Union[str,None],Union[str,None]]
+        The texts of span.a-price-whole, span.a-price-fraction and span#productTitle (None if not found)
+    """
+    return tuple(findSpanText(content,attr,value) for attr,value in FIELDS)
+
+
+def extractSoup(content:bytes) -> Tuple[Union[str,None],Union[str,None],Union[str,None]]:
+    """Same as extractFast, parsing the whole page with BeautifulSoup"""
+    pageContent = BeautifulSoup(content,'html.parser')
+    whole_price = pageContent.find("span",class_="a-price-whole")
+    cent_price = pageContent.find("span",class_="a-price-fraction")
+    title = pageContent.find("span",id="productTitle")
+    return (
+        whole_price.text if whole_price is not None else None,
+        cent_price.text if cent_price is not None else None,
+        title.text if title is not None else None
+    )
+
+
+
+def isBlockPage(content:bytes, end:int=None) -> bool:
+    """Whether the page is a robot check, captcha or soft-block interstitial instead of a product page.
+    Those pages are tiny and carry their markers at the top, so only the first BLOCK_SCAN_BYTES are scanned
+    """
+    if (end is None): end = len(content)
+    end = min(end,BLOCK_SCAN_BYTES)
+    for marker in BLOCK_MARKERS:
+        if (content.find(marker,0,end) != -1): return True
+    return False
+
+
+def pageFingerprint(content:bytes, end:int=None, final:bool=True) -> Union[str,None]:
+    """Returns a compact hash of the regions of the page that hold the title and the price
+
+    Each region is the FINGERPRINT_WINDOW bytes starting at the content of the span findSpan
+    finds (so a marker inside a <script> or a comment is skipped, like the extraction does),
+    if final is False (the page is still being downloaded) None is returned until every
+    window is complete, so that the fingerprint doesn't depend on how the page was chunked
+    """
+    if (end is None): end = len(content)
+    starts = []
+    for attr,value in FINGERPRINT_FIELDS:
+        pos,_ = findSpan(content,attr,value,0,end)
+        if (pos is None): return None
+        starts.append(pos)
+    return windowsFingerprint(content,starts,end,final)
+
+def windowsFingerprint(content:bytes, starts:List[int], end:int=None, final:bool=True) -> Union[str,None]:
+    """Returns the hash of the windows starting at starts (the positions of FINGERPRINT_FIELDS), see pageFingerprint"""
+    if (end is None): end = len(content)
+    h = blake2b(digest_size=8)
+    for pos in starts:
+        if ((not final) and (pos+FINGERPRINT_WINDOW > end)): return None
+        h.update(content[pos:min(end,pos+FINGERPRINT_WINDOW)])
+    return h.hexdigest()
+
+
+
+def extractPriceTitle(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """Extracts the price and the product title from an Amazon product page
+
+    The page goes through the strategies of EXTRACTOR_CHAIN, cheapest reliable one first,
+    the full BeautifulSoup parse is used only when no other strategy finds the fields
+
+    Returns
+    -----
+    Tuple[Union[float,None],Union[str,None]]
+        The price (None if missing or unparsable) and the stripped title (None if missing)
+    """
+
+    price,title,_ = EXTRACTOR_CHAIN.extract(content)
+    return price,title
+
+
+def parseFields(fields:Tuple[Union[str,None],Union[str,None],Union[str,None]]) -> Tuple[Union[float,None],Union[str,None]]:
+    """Turns the texts of the three spans into (price, title)"""
+    whole_price,cent_price,title = fields
+    price = None
+    if ((whole_price is not None) and (cent_price is not None)):
+        # the whole part carries the thousands separators and the decimal mark of the locale ("1.299," or "1,299.")
+        try: price = float(f"{NON_DIGITS.sub('',whole_price)}.{NON_DIGITS.sub('',cent_price)}")
+        except ValueError: price = None
+    return price,(title.strip() if title is not None else None)
+
+
+
+def parsePriceText(text:str) -> Union[float,None]:
+    """Parses a price written in any locale ("89,99 €", "$1,299.00", "1.299,00 €", "1299"):
+    the last separator is the decimal mark only if it's followed by one or two digits
+    """
+    match = PRICE_TEXT.search(text)
+    if (match is None): return None
+    number = re.sub(r"[\s\u00a0\u202f]","",match.group(0)).rstrip(".,")
+    cut = max(number.rfind(","),number.rfind("."))
+    if ((cut != -1) and (len(number)-cut-1 in [1,2])):
+        return float(f"{NON_DIGITS.sub('',number[:cut]) or '0'}.{number[cut+1:]}")
+    digits = NON_DIGITS.sub("",number)
+    return float(digits) if digits else None
+
+
+
+##?## ------------------------------ EXTRACTION STRATEGIES ------------------------------ ##?##
+
+def spansStrategy(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """span.a-price-whole + span.a-price-fraction and span#productTitle, found with extractFast"""
+    return parseFields(extractFast(content))
+
+
+def buyboxStrategy(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """The price element of the buybox and of the older layouts (#price_inside_buybox, #priceblock_ourprice...)"""
+    match = BUYBOX_PRICE.search(content)
+    if (match is None): return None,None
+    return parsePriceText(unescape(match.group(1).decode('utf-8',errors='replace'))),None
+
+
+def corePriceStrategy(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """The "priceAmount" of the corePrice / twister data blobs embedded in the page"""
+    match = CORE_PRICE.search(content)
+    if (match is None): return None,None
+    return float(match.group(1)),None
+
+
+def jsonLdStrategy(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """The offers price and the name of the schema.org Product in the JSON-LD scripts"""
+    price,title = None,None
+    for match in JSON_LD.finditer(content):
+        try: data = loads(match.group(1).decode('utf-8',errors='replace'))
+        except ValueError: continue
+        items = data if isinstance(data,list) else data.get("@graph",[data]) if isinstance(data,dict) else []
+        for item in items:
+            if ((not isinstance(item,dict)) or ("offers" not in item)): continue
+            offers = item["offers"]
+            if (isinstance(offers,list)): offers = offers[0] if len(offers) > 0 else {}
+            if (not isinstance(offers,dict)): continue
+            value = offers.get("price",offers.get("lowPrice",None))
+            if ((price is None) and (value is not None)): price = float(value) if isinstance(value,(int,float)) else parsePriceText(str(value))
+            if ((title is None) and isinstance(item.get("name",None),str)): title = unescape(item["name"]).strip()
+        if ((price is not None) and (title is not None)): break
+    return price,title
+
+
+def metaStrategy(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """The price and og:title <meta> tags (og:price:amount, product:price:amount, itemprop=price)"""
+    price,title = None,None
+    for match in META_TAG.finditer(content):
+        attrs = match.group(1)
+        name = getAttribute(attrs,b"property") or getAttribute(attrs,b"itemprop") or getAttribute(attrs,b"name")
+        value = getAttribute(attrs,b"content")
+        if ((name is None) or (value is None)): continue
+        name = name.lower()
+        if ((price is None) and (name in META_PRICE_NAMES)): price = parsePriceText(unescape(value.decode('utf-8',errors='replace')))
+        elif ((title is None) and (name == b"og:title")): title = unescape(value.decode('utf-8',errors='replace')).strip()
+        if ((price is not None) and (title is not None)): break
+    return price,title
+
+
+def soupStrategy(content:bytes) -> Tuple[Union[float,None],Union[str,None]]:
+    """Same selectors as spansStrategy, parsing the whole page with BeautifulSoup (last resort)"""
+    return parseFields(extractSoup(content))
+
+
+def runStrategies(strategies:List[Tuple[str,Callable[[bytes],Tuple[Union[float,None],Union[str,None]]]]], content:bytes,
+                  price:float=None, title:str=None, skip:Tuple[str,...]=()) -> Tuple[Union[float,None],Union[str,None],Union[str,None],List[Tuple[str,float,bool]]]:
+    """Runs the strategies in order, skipping the ones in skip, until both price and title are known
+
+    It holds no state, so that it can run in a worker process (the strategies must be module-level functions)
+
+    Returns
+    -----
+    Tuple[Union[float,None],Union[str,None],Union[str,None],List[Tuple[str,float,bool]]]
+        The price, the title, the name of the strategy that found the price (None if it was passed in or
+        nothing found it) and the (name, seconds, hit) record of every strategy that ran
+    """
+    source = None
+    records = []
+    for name,strategy in strategies:
+        if ((price is not None) and (title is not None)): break
+        if (name in skip): continue
+        start = perf_counter()
+        try: found_price,found_title = strategy(content)
+        except (ValueError,TypeError,AttributeError): found_price,found_title = None,None
+        records.append((
+            name,
+            perf_counter()-start,
+            ((price is None) and (found_price is not None)) or ((title is None) and (found_title is not None))
+        ))
+        if ((price is None) and (found_price is not None)): price,source = found_price,name
+        if (title is None): title = found_title
+    return price,title,source,records
+
+
+DEFAULT_STRATEGIES = [
+    ("spans",spansStrategy),
+    ("buybox",buyboxStrategy),
+    ("corePrice",corePriceStrategy),
+    ("jsonLd",jsonLdStrategy),
+    ("meta",metaStrategy),
+    ("soup",soupStrategy)
+]
+
+
+
+class ExtractorChain:
+    """Ordered chain of extraction strategies sharing one interface: each one takes the raw page
+    and returns (price, title), None for what it can't find. The strategies are tried in order
+    until both fields are found, and every reorderEvery pages the chain is sorted by the
+    expected cost of a hit (mean latency / hit rate) so that the common case stays the fastest.
+    The pinned strategies are never moved, they always run first and in their order: they read the price
+    of the buybox, while the others can find a different one (e.g. corePrice the price of another variant)
+    and must not win because of the stats of other pages. The fallbacks are never moved either, they always run last
+
+    Attributes
+    -----
+    strategies : List[Tuple[str,Callable[[bytes],Tuple[Union[float,None],Union[str,None]]]]]
+        The (name, strategy) pairs in their current order
+
+    reorderEvery : int
+        Number of extracted pages between two reorderings, 0 to keep the initial order
+
+    pinned : Tuple[str,...]
+        Names of the authoritative strategies, kept at the start of the chain in this order
+
+    fallbacks : Tuple[str,...]
+        Names of the expensive last-resort strategies, kept at the end of the chain
+
+    Methods
+    -----
+    extract(content:bytes, price:float=None, title:str=None, skip:Tuple[str,...]=()) -> Tuple[Union[float,None],Union[str,None],Union[str,None]]
+        Runs the strategies not in skip until both price and title are known (the ones passed in
+        are kept) and returns them with the name of the strategy that found the price
+
+    getStrategies() -> List[Tuple[str,Callable[[bytes],Tuple[Union[float,None],Union[str,None]]]]]
+        Returns a copy of the strategies in their current order
+
+    record(records:List[Tuple[str,float,bool]]) -> None
+        Adds the (name, seconds, hit) records of a page extracted with runStrategies to the stats
+
+    reorder() -> None
+        Sorts the strategies between the pinned ones and the fallbacks by expected cost of a hit,
+        the ones never run go after the others
+
+    getStats() -> Dict[str,Dict[str,float]]
+        Returns calls, hits, hit rate and mean latency (ms) of every strategy, in the current order
+    """
+
+    strategies:List[Tuple[str,Callable[[bytes],Tuple[Union[float,None],Union[str,None]]]]]
+    reorderEvery:int
+    pinned:Tuple[str,...]
+    fallbacks:Tuple[str,...]
+    stats:Dict[str,Dict[str,float]]
+
+    def __init__(self, strategies:List[Tuple[str,Callable[[bytes],Tuple[Union[float,None],Union[str,None]]]]]=DEFAULT_STRATEGIES,
+                 reorderEvery:int=64, pinned:Tuple[str,...]=("spans","buybox"), fallbacks:Tuple[str,...]=("soup",)) -> None:
+        self.strategies = list(strategies)
+        self.reorderEvery = reorderEvery
+        self.pinned = pinned
+        self.fallbacks = fallbacks
+        self.stats = {name:{"calls":0,"hits":0,"seconds":0.0} for name,_ in self.strategies}
+        self._pages = 0
+        self._lock = Lock()
+
+
+    def extract(self, content:bytes, price:float=None, title:str=None, skip:Tuple[str,...]=()) -> Tuple[Union[float,None],Union[str,None],Union[str,None]]:
+        price,title,source,records = runStrategies(self.getStrategies(),content,price,title,skip)
+        self.record(records)
+        return price,title,source
+
+    def getStrategies(self) -> List[Tuple[str,Callable[[bytes],Tuple[Union[float,None],Union[str,None]]]]]:
+        with self._lock: return list(self.strategies)
+
+    def record(self, records:List[Tuple[str,float,bool]]) -> None:
+        with self._lock:
+            for name,elapsed,hit in records:
+                stats = self.stats.setdefault(name,{"calls":0,"hits":0,"seconds":0.0})
+                stats["calls"] += 1
+                stats["seconds"] += elapsed
+                if (hit): stats["hits"] += 1
+            self._pages += 1
+            if ((self.reorderEvery > 0) and (self._pages % self.reorderEvery == 0)): self._reorder()
+
+    def reorder(self) -> None:
+        with self._lock: self._reorder()
+
+    def _reorder(self) -> None:
+        def cost(item:Tuple[str,Callable]) -> Tuple[int,float]:
+            stats = self.stats[item[0]]
+            if (item[0] in self.pinned): return (0,self.pinned.index(item[0]))
+            if (item[0] in self.fallbacks): return (2,0.0)
+            if (stats["calls"] == 0): return (1,float("inf"))
+            hitRate = (stats["hits"]+1)/(stats["calls"]+2)
+            return (1,(stats["seconds"]/stats["calls"])/hitRate)
+        self.strategies.sort(key=cost)
+
+
+    def getStats(self) -> Dict[str,Dict[str,float]]:
+        with self._lock:
+            return {
+                name:{
+                    "calls": self.stats[name]["calls"],
+                    "hits": self.stats[name]["hits"],
+                    "hitRate": round(self.stats[name]["hits"]/self.stats[name]["calls"],2) if self.stats[name]["calls"] > 0 else None,
+                    "ms": round(1000*self.stats[name]["seconds"]/self.stats[name]["calls"],3) if self.stats[name]["calls"] > 0 else None
+                }
+                for name,_ in self.strategies
+            }
+
+
+EXTRACTOR_CHAIN = ExtractorChain()
+
+
+
+class IncrementalExtractor:
+    """Extractor fed with the chunks of a page while it's being downloaded,
+    so that the download can be stopped as soon as every field has been found
+    or the page turns out to be unchanged
+
+    Attributes
+    -----
+    knownFingerprint : Union[str,None]
+        The fingerprint of the last scraped version of the page, if any
+
+    fingerprint : Union[str,None]
+        The fingerprint of the page being downloaded, once its windows are complete
+
+    unchanged : bool
+        True if fingerprint matches knownFingerprint (the fields are not extracted then)
+
+    blocked : bool
+        True if the page is a robot check or soft-block page (see isBlockPage)
+
+    Methods
+    -----
+    feed(chunk:bytes) -> bool
+        Appends chunk to the page and scans only the new content, returns True once every field
+        and the fingerprint are found, or as soon as the page turns out to be unchanged or blocked
+
+    result(fallback:Callable[...,Tuple[Union[float,None],Union[str,None],Union[str,None]]]=None) -> Tuple[Union[float,None],Union[str,None],Union[str,None]]
+        Returns (price, title, source), source being the strategy that found the price ("spans" if it was found
+        while feeding). If the page ended before every field was found, the whole downloaded page goes
+        through fallback for the missing ones (EXTRACTOR_CHAIN.extract if None)
+    """
+
+    buffer:bytearray
+    texts:List[Union[str,None]]
+    knownFingerprint:Union[str,None]
+    fingerprint:Union[str,None]
+    unchanged:bool
+    blocked:bool
+
+    def __init__(self, knownFingerprint:str=None) -> None:
+        self.buffer = bytearray()
+        self.texts = [None]*len(FIELDS)
+        self.knownFingerprint = knownFingerprint
+        self.fingerprint = None
+        self.unchanged = False
+        self.blocked = False
+        self._starts = [None]*len(FIELDS)
+        self._resume = [0]*len(FIELDS)
+        self._fingerprintStarts = [None]*len(FINGERPRINT_FIELDS)
+        self._fingerprintResume = [0]*len(FINGERPRINT_FIELDS)
+
+
+    def feed(self, chunk:bytes) -> bool:
+        self.buffer += chunk
+        end = len(self.buffer)
+        if ((end-len(chunk) < BLOCK_SCAN_BYTES) and isBlockPage(self.buffer,end)):
+            self.blocked = True
+            return True
+        if (self.fingerprint is None):
+            # like the fields, each span of the fingerprint is searched only in the content after the last search
+            for i,(attr,value) in enumerate(FINGERPRINT_FIELDS):
+                if (self._fingerprintStarts[i] is None):
+                    self._fingerprintStarts[i],self._fingerprintResume[i] = findSpan(self.buffer,attr,value,self._fingerprintResume[i],end)
+            if (None not in self._fingerprintStarts): self.fingerprint = windowsFingerprint(self.buffer,self._fingerprintStarts,end,final=False)
+            if ((self.fingerprint is not None) and (self.fingerprint == self.knownFingerprint)):
+                self.unchanged = True
+                return True
+        for i,(attr,value) in enumerate(FIELDS):
+            if (self.texts[i] is not None): continue
+            if (self._starts[i] is None):
+                self._starts[i],self._resume[i] = findSpan(self.buffer,attr,value,self._resume[i],end)
+            if (self._starts[i] is not None):
+                self.texts[i] = spanText(self.buffer,self._starts[i],end)
+        return self.isDone()
+
+    def isDone(self) -> bool:
+        return (None not in self.texts) and (self.fingerprint is not None)
+
+
+    def result(self, fallback:Callable[...,Tuple[Union[float,None],Union[str,None],Union[str,None]]]=None) -> Tuple[Union[float,None],Union[str,None],Union[str,None]]:
+        if ((self.fingerprint is None) and (None not in self._fingerprintStarts)): self.fingerprint = windowsFingerprint(self.buffer,self._fingerprintStarts)
+        price,title = parseFields(tuple(self.texts))
+        if ((price is not None) and (title is not None)): return price,title,"spans"
+        if (fallback is None): fallback = EXTRACTOR_CHAIN.extract
+        found_price,title,source = fallback(bytes(self.buffer),price,title,skip=("spans",))
+        return found_price,title,("spans" if price is not None else source)
@@ -0,0 +1,107 @@
+from random import uniform
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple, Union
+
+
+
+class RetryPolicy:
+    """Retry policy of the scraper: per-attempt timeouts, exponential backoff with full jitter,
+    per-product and per-cycle deadlines and classification of the responses
+
+    Attributes
+    -----
+    maxAttempts : int
+        Maximum number of requests for a single product
+
+    connectTimeout : float
+        Seconds allowed to open a connection
+
+    readTimeout : float
+        Seconds allowed between two bytes of the response
+
+    backoffBase : float
+        Seconds of the first backoff, doubled at every retry
+
+    backoffMax : float
+        Maximum seconds of a single backoff
+
+    productDeadline : float
+        Maximum seconds spent on a single product, retries and backoffs included
+
+    cycleDeadline : float
+        Maximum seconds of a whole update cycle
+
+    Methods
+    -----
+    classify(status_code:int) -> str
+        Returns "ok", "retry" or "fatal"
+
+    backoff(attempt:int) -> float
+        Returns the seconds to wait before retrying after the failed attempt number attempt (from 0)
+
+    productDeadlineFrom(cycleDeadline:float=None) -> float
+        Returns the monotonic deadline of a product scraped now, never later than cycleDeadline
+
+    timeoutFor(deadline:float) -> Union[Tuple[float,float],None]
+        Returns the (connect, read) timeouts of an attempt, None if the deadline has passed
+
+    count(key:str, amount:int=1) -> None
+        Adds amount to the counter named key
+
+    getStats() -> Dict[str,int]
+        Returns the retry counters (attempts, retries, timeouts, connectionErrors, fatal, blocked, deadlineExceeded)
+    """
+
+    RETRYABLE_STATUS = [408,425,429,500,502,503,504]
+
+    maxAttempts:int
+    connectTimeout:float
+    readTimeout:float
+    backoffBase:float
+    backoffMax:float
+    productDeadline:float
+    cycleDeadline:float
+    stats:Dict[str,int]
+
+    def __init__(self, maxAttempts:int=6, connectTimeout:float=5.0, readTimeout:float=15.0, backoffBase:float=1.0,
+                 backoffMax:float=30.0, productDeadline:float=120.0, cycleDeadline:float=3600.0) -> None:
+        self.maxAttempts = max(1,maxAttempts)
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.productDeadline = productDeadline
+        self.cycleDeadline = cycleDeadline
+        self.stats = {"attempts":0,"retries":0,"timeouts":0,"connectionErrors":0,"fatal":0,"blocked":0,"deadlineExceeded":0}
+        self._lock = Lock()
+
+
+    def classify(self, status_code:int) -> str:
+        if (status_code in [200,304]): return "ok"
+        if ((status_code in self.RETRYABLE_STATUS) or (status_code >= 500)): return "retry"
+        return "fatal"
+
+    def backoff(self, attempt:int) -> float:
+        return uniform(0,min(self.backoffMax,self.backoffBase*(2**attempt)))
+
+
+    def newCycleDeadline(self) -> float:
+        return monotonic() + self.cycleDeadline
+
+    def productDeadlineFrom(self, cycleDeadline:float=None) -> float:
+        deadline = monotonic() + self.productDeadline
+        if (cycleDeadline is not None): deadline = min(deadline,cycleDeadline)
+        return deadline
+
+    def timeoutFor(self, deadline:float) -> Union[Tuple[float,float],None]:
+        remaining = deadline - monotonic()
+        if (remaining <= 0): return None
+        return (min(self.connectTimeout,remaining),min(self.readTimeout,remaining))
+
+
+    def count(self, key:str, amount:int=1) -> None:
+        with self._lock: self.stats[key] = self.stats.get(key,0) + amount
+
+    def getStats(self) -> Dict[str,int]:
+        with self._lock: return dict(self.stats)
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from threading import Event, Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Tuple, Type
+
+
+
+class InFlight:
+    """A fetch in progress, waited on by every request for the same key"""
+
+    def __init__(self) -> None:
+        self.event = Event()
+        self.value = None
+        self.error = None
+
+
+
+class ScrapeCache:
+    """In-process TTL cache of scrape results with LRU eviction and in-flight request coalescing
+
+    Attributes
+    -----
+    ttl : float
+        Seconds a successful result stays valid
+
+    negativeTtl : float
+        Seconds a negative result (one of negativeExceptions) stays valid
+
+    maxSize : int
+        Maximum number of cached results, the least recently used one is evicted first
+
+    negativeExceptions : Tuple[Type[Exception],...]
+        The exceptions that are cached as negative results, any other exception is not cached
+
+    Methods
+    -----
+    get(key:str, fetch:Callable[[],Any], cacheable:Callable[[Any],bool]=None) -> Any
+        Returns the cached result of key, or fetches it. Concurrent calls for the same key
+        wait on a single fetch
+
+    invalidate(key:str) -> None
+        Removes the cached result of key
+
+    getStats() -> Dict[str,int]
+        Returns the cache counters (hits, negativeHits, misses, coalesced, evictions, size)
+    """
+
+    ttl:float
+    negativeTtl:float
+    maxSize:int
+    negativeExceptions:Tuple[Type[Exception],...]
+    stats:Dict[str,int]
+
+    def __init__(self, ttl:float=600.0, negativeTtl:float=300.0, maxSize:int=1024, negativeExceptions:Tuple[Type[Exception],...]=()) -> None:
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.maxSize = maxSize
+        self.negativeExceptions = negativeExceptions
+        self.stats = {"hits":0,"negativeHits":0,"misses":0,"coalesced":0,"evictions":0}
+        self._entries:OrderedDict = OrderedDict()
+        self._inFlight:Dict[str,InFlight] = {}
+        self._lock = Lock()
+
+
+    def get(self, key:str, fetch:Callable[[],Any], cacheable:Callable[[Any],bool]=None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key,None)
+            if (entry is not None):
+                expires,value,error = entry
+                if (expires > monotonic()):
+                    self._entries.move_to_end(key)
+                    if (error is not None):
+                        self.stats["negativeHits"] += 1
+                        raise error
+                    self.stats["hits"] += 1
+                    return value
+                del self._entries[key]
+            flight = self._inFlight.get(key,None)
+            leader = flight is None
+            if (leader):
+                flight = InFlight()
+                self._inFlight[key] = flight
+                self.stats["misses"] += 1
+            else: self.stats["coalesced"] += 1
+
+        if (not leader):
+            flight.event.wait()
+            if (flight.error is not None): raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+            if ((cacheable is None) or cacheable(flight.value)): self.store(key,flight.value,None)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            if (isinstance(e,self.negativeExceptions)): self.store(key,None,e)
+            raise
+        finally:
+            with self._lock: self._inFlight.pop(key,None)
+            flight.event.set()
+
+
+    def store(self, key:str, value:Any, error:Exception) -> None:
+        expires = monotonic() + (self.negativeTtl if error is not None else self.ttl)
+        with self._lock:
+            self._entries[key] = (expires,value,error)
+            self._entries.move_to_end(key)
+            while (len(self._entries) > self.maxSize):
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, key:str) -> None:
+        with self._lock: self._entries.pop(key,None)
+
+
+    def getStats(self) -> Dict[str,int]:
+        with self._lock:
+            out_d = dict(self.stats)
+            out_d["size"] = len(self._entries)
+        return out_d
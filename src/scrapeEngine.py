@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+from zlib import crc32
+from typing import Any, Callable, Dict, Iterable, List, Union
+
+
+
+class JobCancelledException(Exception):
+    """Exception returned in place of the result of a job that wasn't started because the engine is stopping
+    """
+    pass
+
+
+
+class ScrapeEngine:
+    """Bounded thread pool used to run the scraping jobs of an update cycle concurrently
+
+    Attributes
+    -----
+    maxWorkers : int
+        The maximum number of scraping jobs running at the same time
+
+    Methods
+    -----
+    run(job:Callable[[Any],Any], items:Iterable[Any], onResult:Callable[[int,Any],None]=None) -> List[Union[Any,Exception]]
+        Runs job on every item and returns the results in the same order of items.
+        Exceptions raised by a job are returned in place of its result, so a single
+        bad product does not abort the whole cycle. onResult (if given) is called with the
+        index of the item and its result as soon as each job finishes, from the worker thread
+
+    stop() -> None
+        Lets the running jobs finish (drain) and cancels the ones not started yet,
+        which get a JobCancelledException as result. Every later run is cancelled too
+
+    isStopping() -> bool
+        Whether stop has been called
+    """
+
+    maxWorkers:int
+
+    def __init__(self, maxWorkers:int=8) -> None:
+        self.maxWorkers = max(1,maxWorkers)
+        self._stopping = Event()
+
+
+    def run(self, job:Callable[[Any],Any], items:Iterable[Any], onResult:Callable[[int,Any],None]=None) -> List[Union[Any,Exception]]:
+        items = list(items)
+        if (len(items) == 0): return []
+
+        def safeJob(index:int, item:Any) -> Union[Any,Exception]:
+            if (self._stopping.is_set()): result = JobCancelledException()
+            else:
+                try: result = job(item)
+                except Exception as e: result = e
+            if (onResult is not None): onResult(index,result)
+            return result
+
+        if ((self.maxWorkers == 1) or (len(items) == 1)):
+            return [safeJob(index,item) for index,item in enumerate(items)]
+        with ThreadPoolExecutor(max_workers=min(self.maxWorkers,len(items))) as executor:
+            return list(executor.map(safeJob,range(len(items)),items))
+
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    def isStopping(self) -> bool:
+        return self._stopping.is_set()
+
+
+
+def shardOf(key:str, shards:int) -> int:
+    """Returns the shard (0 to shards-1) of a product key, stable across restarts unlike hash()"""
+    return crc32(key.encode('utf-8')) % max(1,shards)
+
+
+
+class CycleSummary:
+    """Thread-safe counters describing what happened during an update cycle
+
+    Methods
+    -----
+    increment(key:str, amount:int=1) -> None
+        Adds amount to the counter named key
+
+    set(key:str, value:int) -> None
+        Sets the counter named key to value
+
+    get(key:str) -> int
+        Returns the value of the counter named key, 0 if it was never incremented
+    """
+
+    counters:Dict[str,int]
+
+    def __init__(self) -> None:
+        self.counters = {}
+        self._lock = Lock()
+
+    def __str__(self) -> str:
+        return "\n".join(f"{key}: {value}" for key,value in self.counters.items())
+    def __repr__(self) -> str:
+        return "\n".join(f"{key}: {value}" for key,value in self.counters.items())
+
+
+    def increment(self, key:str, amount:int=1) -> None:
+        with self._lock:
+            self.counters[key] = self.counters.get(key,0) + amount
+
+    def set(self, key:str, value:int) -> None:
+        with self._lock:
+            self.counters[key] = value
+
+    def get(self, key:str) -> int:
+        return self.counters.get(key,0)
@@ -0,0 +1,289 @@
+from time import monotonic, sleep
+from typing import Tuple, Union
+from requests.exceptions import RequestException, Timeout
+from httpSession import HttpSession, SESSION
+from hostThrottle import HostThrottle
+from retryPolicy import RetryPolicy
+from pageState import PageStateStore
+from scrapeCache import ScrapeCache
+from priceExtractor import pageFingerprint, isBlockPage, IncrementalExtractor
+from parsePool import ParsePool
+from scrapeEngine import CycleSummary
+
+
+
+class BadAmazonProductException(Exception):
+    """Exception raised when an Amazon product's page is not fit to be scraped
+    """
+    pass
+class ScrapeFailedException(Exception):
+    """Exception raised when a page couldn't be scraped within the retry policy's attempts and deadlines
+    """
+    pass
+class AmazonBlockedException(ScrapeFailedException):
+    """Exception raised when Amazon kept answering with robot checks or throttling pages until the deadline
+    """
+    pass
+
+
+
+class Scraper:
+    """Fetches Amazon product pages and extracts their title and price
+
+    Attributes
+    -----
+    session : HttpSession
+        The HTTP transport used for every request
+
+    stream : bool
+        Whether pages are streamed and their download stopped as soon as the fields are found,
+        otherwise the whole page is downloaded
+
+    pageStates : Union[PageStateStore,None]
+        The validators and fingerprints of the last scraped pages. When set, unchanged pages
+        are requested conditionally and aren't parsed again
+
+    cache : Union[ScrapeCache,None]
+        The recent results, keyed like pageStates. When set, a product scraped less than
+        cache.ttl seconds ago isn't fetched again and concurrent scrapes of the same product
+        share a single fetch
+
+    retryPolicy : RetryPolicy
+        Timeouts, backoff, deadlines and classification of the responses
+
+    throttle : HostThrottle
+        Per-host rate and concurrency limits every request has to go through
+
+    parser : ParsePool
+        The parse stage the downloaded pages are handed over to, so that fetch threads stay I/O-bound
+
+    Methods
+    -----
+    scrape(url:str, key:str=None, summary:CycleSummary=None, max_retries:int=None, deadline:float=None) -> Tuple[str,float]
+        Returns the (fullName, price) of the page at url, from the cache if possible
+
+    scrapeUncached(url:str, key:str=None, summary:CycleSummary=None, max_retries:int=None, deadline:float=None) -> Tuple[str,float]
+        Scrapes the page at url and returns its (fullName, price)
+
+    resolveShortLink(url:str, max_retries:int=None) -> str
+        Follows the redirects of an Amazon short link and returns the final URL
+    """
+
+    session:HttpSession
+    stream:bool
+    pageStates:Union[PageStateStore,None]
+    cache:Union[ScrapeCache,None]
+    retryPolicy:RetryPolicy
+    throttle:HostThrottle
+    parser:ParsePool
+
+    def __init__(self, session:HttpSession=SESSION, stream:bool=True, pageStates:PageStateStore=None, cache:ScrapeCache=None,
+                 retryPolicy:RetryPolicy=None, throttle:HostThrottle=None, parser:ParsePool=None) -> None:
+        self.session = session
+        self.stream = stream
+        self.pageStates = pageStates
+        self.cache = cache
+        self.retryPolicy = retryPolicy if retryPolicy is not None else RetryPolicy()
+        self.throttle = throttle if throttle is not None else HostThrottle()
+        self.parser = parser if parser is not None else ParsePool(0)
+
+
+    def scrape(self, url:str, key:str=None, summary:CycleSummary=None, max_retries:int=None, deadline:float=None) -> Tuple[str,float]:
+        """Same as scrapeUncached, going through the cache when both cache and key are set.
+        Pages that turned out to be BadAmazonProductException are cached too (negative results)
+        """
+        if ((self.cache is None) or (key is None)): return self.scrapeUncached(url,key,summary,max_retries,deadline)
+        fetched = []
+        def fetch() -> Tuple[str,float]:
+            fetched.append(True)
+            return self.scrapeUncached(url,key,summary,max_retries,deadline)
+        try: return self.cache.get(key,fetch,cacheable=(lambda result: result[1] is not None))
+        finally:
+            if (len(fetched) == 0): self.count(summary,"cacheHits")
+
+
+    def scrapeUncached(self, url:str, key:str=None, summary:CycleSummary=None, max_retries:int=None, deadline:float=None) -> Tuple[str,float]:
+        """Scrapes the Amazon page at url and returns its (fullName, price),
+        without touching any Product so that one fetch can be shared by many entries
+
+        Parameters
+        -----
+        url : str
+            The URL of the product page
+
+        key : str (optional)
+            The key (canonical URL) under which the page state is stored, no state is used if None
+
+        summary : CycleSummary (optional)
+            The counters of the current cycle (pagesFetched, notModified, unchanged, extracted, retries, blocked)
+
+        max_retries : int (optional)
+            Maximum number of requests, retryPolicy.maxAttempts if None
+
+        deadline : float (optional)
+            The monotonic deadline of the whole update cycle, if any
+
+        Raises
+        -----
+        BadAmazonProductException, ScrapeFailedException, AmazonBlockedException
+        """
+
+        policy = self.retryPolicy
+        attempts = max_retries if max_retries is not None else policy.maxAttempts
+        productDeadline = policy.productDeadlineFrom(deadline)
+        state = self.pageStates.get(key) if ((self.pageStates is not None) and (key is not None)) else None
+        if ((state is not None) and ((state.get("price",None) is None) or (state.get("fullName",None) is None))): state = None
+        # the fingerprint covers the windows of the spans strategy: a price found by another one can change outside them
+        knownFingerprint = state.get("fingerprint",None) if ((state is not None) and (state.get("priceSource",None) == "spans")) else None
+        headers = {}
+        if (state is not None):
+            if (state.get("etag",None) is not None): headers["If-None-Match"] = state["etag"]
+            if (state.get("lastModified",None) is not None): headers["If-Modified-Since"] = state["lastModified"]
+
+        deadlineExceeded = False
+        blocked = False
+        backoff = False
+        attempt = 0
+        while (attempt < attempts):
+            if (backoff):
+                wait = policy.backoff(attempt-1)
+                if (monotonic()+wait >= productDeadline):
+                    deadlineExceeded = True
+                    break
+                policy.count("retries")
+                self.count(summary,"retries")
+                sleep(wait)
+            backoff = True
+            if (not self.throttle.acquire(url,productDeadline)):
+                deadlineExceeded = True
+                break
+            timeout = policy.timeoutFor(productDeadline)
+            if (timeout is None):
+                self.throttle.cancel(url)
+                deadlineExceeded = True
+                break
+            policy.count("attempts")
+
+            start = monotonic()
+            try:
+                if (self.stream):
+                    extractor = IncrementalExtractor(knownFingerprint)
+                    r = self.session.getStream(url,extractor.feed,headers=headers,timeout=timeout)
+                else:
+                    r = self.session.get(url,headers=headers,timeout=timeout)
+            except Timeout:
+                self.throttle.release(url,"error",monotonic()-start)
+                policy.count("timeouts")
+                attempt += 1
+                continue
+            except RequestException:
+                self.throttle.release(url,"error",monotonic()-start)
+                policy.count("connectionErrors")
+                attempt += 1
+                continue
+            throttled = (r.status_code == 429)
+            blocked = throttled or (r.status_code == 503) or (
+                (r.status_code == 200) and (extractor.blocked if self.stream else isBlockPage(r.content))
+            )
+            if (blocked):
+                # a 429 slows the host down and is retried after the backoff, the cooldown of a robot check
+                # (or 503 page) replaces the backoff; neither uses up attempts
+                self.throttle.release(url,("throttled" if throttled else "blocked"),monotonic()-start)
+                policy.count("blocked")
+                self.count(summary,"blocked")
+                backoff = throttled
+                continue
+            self.throttle.release(url,"ok",monotonic()-start)
+            if ((r.status_code == 304) and (state is not None)):
+                self.count(summary,"notModified")
+                return state["fullName"],state["price"]
+            verdict = policy.classify(r.status_code)
+            if (verdict == "retry"):
+                attempt += 1
+                continue
+            if (verdict == "fatal"):
+                policy.count("fatal")
+                raise BadAmazonProductException
+            self.count(summary,"pagesFetched")
+
+            if (self.stream):
+                unchanged = extractor.unchanged
+                if (not unchanged): price,fullName,source = extractor.result(self.parser.parse)
+                fingerprint = extractor.fingerprint
+            else:
+                fingerprint = pageFingerprint(r.content)
+                unchanged = (fingerprint is not None) and (fingerprint == knownFingerprint)
+                if (not unchanged): price,fullName,source = self.parser.parse(r.content)
+            if (unchanged):
+                self.count(summary,"unchanged")
+                price,fullName,source = state["price"],state["fullName"],state["priceSource"]
+            else: self.count(summary,"extracted")
+
+            if ((price is None) or (fullName is None)): raise BadAmazonProductException
+
+            if ((self.pageStates is not None) and (key is not None)):
+                self.pageStates.set(key,{
+                    "etag": r.headers.get("ETag",None),
+                    "lastModified": r.headers.get("Last-Modified",None),
+                    "fingerprint": fingerprint,
+                    "fullName": fullName,
+                    "price": price,
+                    "priceSource": source
+                })
+            return fullName,price
+
+        if (deadlineExceeded):
+            policy.count("deadlineExceeded")
+            self.count(summary,"deadlineExceeded")
+        if (blocked): raise AmazonBlockedException
+        raise ScrapeFailedException
+
+
+    def resolveShortLink(self, url:str, max_retries:int=None) -> str:
+        """Follows the redirects of an Amazon short link (amzn.eu, amzn.to...) and returns the final URL,
+        going through the throttle with the timeouts, backoff and product deadline of retryPolicy
+
+        Raises
+        -----
+        ScrapeFailedException
+        """
+
+        policy = self.retryPolicy
+        attempts = max_retries if max_retries is not None else policy.maxAttempts
+        productDeadline = policy.productDeadlineFrom()
+        deadlineExceeded = False
+        for attempt in range(attempts):
+            if (attempt > 0):
+                wait = policy.backoff(attempt-1)
+                if (monotonic()+wait >= productDeadline):
+                    deadlineExceeded = True
+                    break
+                policy.count("retries")
+                sleep(wait)
+            if (not self.throttle.acquire(url,productDeadline)):
+                deadlineExceeded = True
+                break
+            timeout = policy.timeoutFor(productDeadline)
+            if (timeout is None):
+                self.throttle.cancel(url)
+                deadlineExceeded = True
+                break
+            policy.count("attempts")
+            start = monotonic()
+            try: r = self.session.head(url,allow_redirects=True,timeout=timeout)
+            except Timeout:
+                self.throttle.release(url,"error",monotonic()-start)
+                policy.count("timeouts")
+                continue
+            except RequestException:
+                self.throttle.release(url,"error",monotonic()-start)
+                policy.count("connectionErrors")
+                continue
+            self.throttle.release(url,"ok",monotonic()-start)
+            return r.url
+        if (deadlineExceeded): policy.count("deadlineExceeded")
+        raise ScrapeFailedException
+
+
+    def count(self, summary:Union[CycleSummary,None], key:str) -> None:
+        if (summary is not None): summary.increment(key)
@@ -0,0 +1,646 @@
+from collections.abc import MutableMapping
+from json import load,dump,loads,dumps
+from os import listdir,makedirs,replace,remove,fsync
+from os.path import dirname,isdir,isfile,join,splitext
+import sqlite3
+from contextlib import contextmanager
+from sys import intern
+from threading import Lock, Thread, Timer
+from typing import Callable, Dict, Iterable, Iterator, List
+
+
+
+class Storage:
+    """Persistence backend of AWSDatabase: an in-memory mirror of the database
+    (user ID -> watchlist name -> watchlist dictionary, the format of Watchlist.toDict)
+    kept in sync with its file by small mutation records instead of rewriting the whole database
+
+    Each record is a dictionary with the key "op" and the user ID in "user":
+    {"op":"addUser"}, {"op":"removeUser"}, {"op":"updateUser", "watchlists":user_dict},
+    {"op":"addWatchlist", "wl":name, "watchlist":wl_dict}, {"op":"removeWatchlist", "wl":name},
+    {"op":"addProduct"/"removeProduct", "wl":name, "product":product_dict, "total":new_total}
+
+    Subclasses implement _read (the whole database from the file) and _write (persist a batch of records)
+
+    A mutation is applied to the mirror right away, while its record is queued and its user marked dirty:
+    the queue is persisted as a single batch (group commit) flushDelay seconds after the first queued record,
+    when a batch context ends or when flush is called. Before being written the queue is coalesced,
+    dropping the records of a user that a later updateUser/removeUser of the same user overwrites
+
+    Attributes
+    -----
+    data : Dict[int,Dict[str,dict]]
+        The mirror of the database, never to be modified directly (use the mutation methods)
+
+    flushDelay : float
+        Seconds a mutation can wait in the queue (debounce window), 0 to persist every mutation right away
+
+    stats : Dict[str,int]
+        "mutations" (records applied), "coalesced" (records dropped by coalescing), "writes" (batches persisted),
+        "dirtyUsers" (users written, summed over the batches), "bytesWritten" (json files) or "rowsWritten" (SQLite)
+
+    Methods
+    -----
+    load() -> Dict[int,Dict[str,dict]]
+        Reads the database from the file and returns the mirror
+
+    addUser(user_id:int) / removeUser(user_id:int) -> None
+        Adds an empty user / removes a user with all their watchlists
+
+    updateUsers(users:Dict[int,Dict[str,dict]]) -> None
+        Replaces the watchlists of every user in users (used by the update cycles)
+
+    addWatchlist(user_id:int, wl_name:str, wl_dict:dict) / removeWatchlist(user_id:int, wl_name:str) -> None
+        Adds / removes a watchlist of a user
+
+    addProduct(user_id:int, wl_name:str, product:dict, total:float) / removeProduct(...) -> None
+        Adds / removes a product of a watchlist, total is the new total of the watchlist
+
+    flush() -> None
+        Persists the queued mutations now
+
+    batch() -> Iterator[None]
+        Context manager that holds the queued mutations until it ends, then flushes them
+
+    close() -> None
+        Flushes the queued mutations and releases the file handles
+
+    getStats() -> Dict[str,float]
+        Returns the counters, with the bytes written per mutation (write amplification)
+    """
+
+    data:Dict[int,Dict[str,dict]]
+    flushDelay:float
+    stats:Dict[str,int]
+
+    def __init__(self, flushDelay:float=0.0) -> None:
+        self.data = {}
+        self.flushDelay = max(0.0,flushDelay)
+        self.stats = {"mutations":0,"coalesced":0,"writes":0,"dirtyUsers":0,"bytesWritten":0}
+        self._lock = Lock()
+        self._pending:List[dict] = []
+        self._batches = 0
+        self._timer = None
+
+
+    def load(self) -> Dict[int,Dict[str,dict]]:
+        with self._lock:
+            self._flush()
+            self.data = self._read()
+            return self.data
+
+    def addUser(self, user_id:int) -> None:
+        self._commit([{"op":"addUser","user":user_id}])
+
+    def removeUser(self, user_id:int) -> None:
+        self._commit([{"op":"removeUser","user":user_id}])
+
+    def updateUsers(self, users:Dict[int,Dict[str,dict]]) -> None:
+        self._commit([{"op":"updateUser","user":user_id,"watchlists":user_dict} for user_id,user_dict in users.items()])
+
+    def addWatchlist(self, user_id:int, wl_name:str, wl_dict:dict) -> None:
+        self._commit([{"op":"addWatchlist","user":user_id,"wl":wl_name,"watchlist":wl_dict}])
+
+    def removeWatchlist(self, user_id:int, wl_name:str) -> None:
+        self._commit([{"op":"removeWatchlist","user":user_id,"wl":wl_name}])
+
+    def addProduct(self, user_id:int, wl_name:str, product:dict, total:float) -> None:
+        self._commit([{"op":"addProduct","user":user_id,"wl":wl_name,"product":product,"total":total}])
+
+    def removeProduct(self, user_id:int, wl_name:str, product:dict, total:float) -> None:
+        self._commit([{"op":"removeProduct","user":user_id,"wl":wl_name,"product":product,"total":total}])
+
+    def flush(self) -> None:
+        with self._lock: self._flush()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        with self._lock: self._batches += 1
+        try: yield
+        finally:
+            with self._lock:
+                self._batches -= 1
+                if (self._batches == 0): self._flush()
+
+    def close(self) -> None:
+        self.flush()
+
+    def getStats(self) -> Dict[str,float]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+        for key in ["bytesWritten","rowsWritten"]:
+            if (key in stats): stats[key.replace("Written","PerMutation")] = round(stats[key]/stats["mutations"],1) if stats["mutations"] > 0 else None
+        return stats
+
+
+    def _commit(self, records:List[dict]) -> None:
+        if (len(records) == 0): return
+        with self._lock:
+            for record in records: self._apply(self.data,record)
+            self._pending.extend(records)
+            self.stats["mutations"] += len(records)
+            if (self._batches > 0): return
+            if (self.flushDelay == 0): self._flush()
+            elif (self._timer is None):
+                self._timer = Timer(self.flushDelay,self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush(self) -> None:
+        if (self._timer is not None):
+            self._timer.cancel()
+            self._timer = None
+        if (len(self._pending) == 0): return
+        records,self._pending = self._coalesce(self._pending),[]
+        self._write(records)
+        self.stats["writes"] += 1
+        self.stats["dirtyUsers"] += len({record["user"] for record in records})
+
+    def _coalesce(self, records:List[dict]) -> List[dict]:
+        """Drops the records overwritten by a later updateUser/removeUser of the same user"""
+        kept = []
+        overwritten = set()
+        for record in reversed(records):
+            if (record["user"] in overwritten):
+                self.stats["coalesced"] += 1
+                continue
+            if (record["op"] in ["updateUser","removeUser"]): overwritten.add(record["user"])
+            kept.append(record)
+        kept.reverse()
+        return kept
+
+    @staticmethod
+    def _apply(data:Dict[int,Dict[str,dict]], record:dict) -> None:
+        """Applies a mutation record to a database dictionary, copying what it stores
+        so that the queued records never change after being created
+        """
+        op,user_id = record["op"],record["user"]
+        if (op == "addUser"): data.setdefault(user_id,{})
+        elif (op == "removeUser"): data.pop(user_id,None)
+        elif (op == "updateUser"): data[user_id] = {wl_name:copyWatchlist(wl_dict) for wl_name,wl_dict in record["watchlists"].items()}
+        elif (op == "addWatchlist"): data.setdefault(user_id,{})[record["wl"]] = copyWatchlist(record["watchlist"])
+        elif (op == "removeWatchlist"): data.get(user_id,{}).pop(record["wl"],None)
+        elif (op in ["addProduct","removeProduct"]):
+            wl_dict = data[user_id][record["wl"]]
+            if (op == "addProduct"): wl_dict["products"].append(dict(record["product"]))
+            else:
+                for i,prod_d in enumerate(wl_dict["products"]):
+                    if ((prod_d["url"] == record["product"]["url"]) and (prod_d["name"] == record["product"]["name"])):
+                        wl_dict["products"].pop(i)
+                        break
+            wl_dict["total"] = record["total"]
+
+    def _read(self) -> Dict[int,Dict[str,dict]]:
+        raise NotImplementedError
+
+    def _write(self, records:List[dict]) -> None:
+        raise NotImplementedError
+
+
+
+def copyWatchlist(wl_dict:dict) -> dict:
+    return {**wl_dict,"products":[dict(prod_d) for prod_d in wl_dict["products"]]}
+
+def internProduct(d:dict) -> dict:
+    """json object_hook that interns the strings of the product dictionaries, so that the same
+    url or name tracked in several watchlists (and by the live Products) is stored only once
+    """
+    if ("url" in d):
+        for key in ("url","asin","name","fullName"):
+            if (isinstance(d.get(key,None),str)): d[key] = intern(d[key])
+    return d
+
+
+
+class JsonStorage(Storage):
+    """The whole database in a single json file, rewritten (atomically) by every batch of mutations
+
+    Attributes
+    -----
+    jsonPath : str
+        The filepath of the json file containing the database
+    """
+
+    jsonPath:str
+
+    def __init__(self, jsonPath:str, flushDelay:float=0.0) -> None:
+        super().__init__(flushDelay)
+        self.jsonPath = jsonPath
+
+    def _read(self) -> Dict[int,Dict[str,dict]]:
+        if (not isfile(self.jsonPath)): return {}
+        with open(self.jsonPath,"r",encoding='utf-8') as r_file:
+            tmp_d = load(r_file,object_hook=internProduct)
+        return {int(k):v for k,v in tmp_d.items() if k != JournalStorage.SEQ_KEY}
+
+    def _write(self, records:List[dict]) -> None:
+        with open(self.jsonPath+".tmp","w",encoding='utf-8') as w_file:
+            dump(self.data,w_file,indent=4)
+            self.stats["bytesWritten"] += w_file.tell()
+        replace(self.jsonPath+".tmp",self.jsonPath)
+
+
+
+class JournalStorage(JsonStorage):
+    """The json database as a snapshot plus an append-only journal of the mutation records
+    (one compact json line each, numbered by "seq"): a mutation only appends a line to the journal,
+    and a crash can at most cut the last line, which is dropped when the journal is replayed
+
+    Once the journal holds compactEvery records a background thread folds it into a new snapshot:
+    the journal is rotated (to journalPath.1, appended to it if a crashed compaction left one), the snapshot
+    is written to a temporary file that then replaces jsonPath and the rotated journal is removed. The snapshot stores the seq of its last
+    record (in SEQ_KEY), so the records it already contains are skipped wherever compaction stopped
+
+    Attributes
+    -----
+    journalPath : str
+        The filepath of the journal
+
+    compactEvery : int
+        Number of journal records that triggers a compaction
+
+    Methods
+    -----
+    compact() -> None
+        Folds the journal into the snapshot
+    """
+
+    SEQ_KEY = "journalSeq"
+
+    journalPath:str
+    compactEvery:int
+
+    def __init__(self, jsonPath:str, journalPath:str, compactEvery:int=1000, flushDelay:float=0.0) -> None:
+        super().__init__(jsonPath,flushDelay)
+        self.journalPath = journalPath
+        self.compactEvery = max(1,compactEvery)
+        self.stats.update({"journalRecords":0,"compactions":0})
+        self._seq = 0
+        self._journal = None
+        self._compactLock = Lock()
+        self._compacting = False
+
+
+    def load(self) -> Dict[int,Dict[str,dict]]:
+        # not while a compaction is moving the snapshot and the journal
+        with self._compactLock: return super().load()
+
+    def compact(self) -> None:
+        with self._compactLock:
+            with self._lock:
+                # the queued records go to the journal first, the snapshot must not contain records it doesn't number
+                self._flush()
+                snapshot = {str(k):v for k,v in self.data.items()}
+                snapshot[self.SEQ_KEY] = self._seq
+                text = dumps(snapshot)
+                self._closeJournal()
+                if (isfile(self.journalPath)): self._rotateJournal()
+                self.stats["journalRecords"] = 0
+            with open(self.jsonPath+".tmp","w",encoding='utf-8') as w_file:
+                w_file.write(text)
+                w_file.flush()
+                fsync(w_file.fileno())
+            replace(self.jsonPath+".tmp",self.jsonPath)
+            if (isfile(self.journalPath+".1")): remove(self.journalPath+".1")
+            with self._lock:
+                self.stats["compactions"] += 1
+                self.stats["bytesWritten"] += len(text.encode('utf-8'))
+                self._compacting = False
+
+    def close(self) -> None:
+        self.flush()
+        if (self.stats["journalRecords"] > 0): self.compact()
+        with self._lock: self._closeJournal()
+
+
+    def _read(self) -> Dict[int,Dict[str,dict]]:
+        self._closeJournal()
+        base = 0
+        data = {}
+        if (isfile(self.jsonPath)):
+            with open(self.jsonPath,"r",encoding='utf-8') as r_file:
+                tmp_d = load(r_file,object_hook=internProduct)
+            base = tmp_d.pop(self.SEQ_KEY,0)
+            data = {int(k):v for k,v in tmp_d.items()}
+        self._seq = base
+        self.stats["journalRecords"] = 0
+        for path in [self.journalPath+".1",self.journalPath]:
+            if (not isfile(path)): continue
+            valid = 0
+            with open(path,"rb") as r_file:
+                for line in r_file:
+                    try: record = loads(line,object_hook=internProduct)
+                    except ValueError: break
+                    valid += len(line)
+                    self.stats["journalRecords"] += 1
+                    # records already in the snapshot, or in both files if the crash came while they were appended
+                    if (record["seq"] <= self._seq): continue
+                    record["user"] = int(record["user"])
+                    self._apply(data,record)
+                    self._seq = record["seq"]
+            # a line cut by a crash is dropped, so that the next records aren't appended after it
+            with open(path,"r+b") as w_file: w_file.truncate(valid)
+        return data
+
+    def _write(self, records:List[dict]) -> None:
+        if (self._journal is None): self._journal = open(self.journalPath,"a",encoding='utf-8')
+        lines = ""
+        for record in records:
+            self._seq += 1
+            lines += dumps({**record,"seq":self._seq},separators=(",",":")) + "\n"
+        self._journal.write(lines)
+        self._journal.flush()
+        fsync(self._journal.fileno())
+        self.stats["journalRecords"] += len(records)
+        self.stats["bytesWritten"] += len(lines.encode('utf-8'))
+        if ((self.stats["journalRecords"] >= self.compactEvery) and (not self._compacting)):
+            self._compacting = True
+            Thread(target=self.compact,daemon=True).start()
+
+    def _rotateJournal(self) -> None:
+        if (not isfile(self.journalPath+".1")):
+            replace(self.journalPath,self.journalPath+".1")
+            return
+        # a compaction that crashed before replacing the snapshot left its rotated journal, whose records
+        # aren't in the snapshot yet: the journal is appended to it, so that neither is lost if this one crashes too
+        with open(self.journalPath,"rb") as r_file, open(self.journalPath+".1","ab") as w_file:
+            w_file.write(r_file.read())
+            w_file.flush()
+            fsync(w_file.fileno())
+        remove(self.journalPath)
+
+    def _closeJournal(self) -> None:
+        if (self._journal is not None):
+            self._journal.close()
+            self._journal = None
+
+
+
+class LazyUsers(MutableMapping):
+    """User ID -> watchlists mapping that knows which users exist but reads each of them
+    (with reader) only the first time it's accessed
+
+    Methods
+    -----
+    loadedUsers() -> int
+        Returns how many users have been read so far
+    """
+
+    def __init__(self, userIds:Iterable[int], reader:Callable[[int],Dict[str,dict]]) -> None:
+        self._ids = set(userIds)
+        self._users:Dict[int,Dict[str,dict]] = {}
+        self._reader = reader
+        self._lock = Lock()
+
+    def __getitem__(self, user_id:int) -> Dict[str,dict]:
+        with self._lock:
+            if (user_id not in self._ids): raise KeyError(user_id)
+            if (user_id not in self._users): self._users[user_id] = self._reader(user_id)
+            return self._users[user_id]
+
+    def __setitem__(self, user_id:int, user_dict:Dict[str,dict]) -> None:
+        with self._lock:
+            self._ids.add(user_id)
+            self._users[user_id] = user_dict
+
+    def __delitem__(self, user_id:int) -> None:
+        with self._lock:
+            self._ids.remove(user_id)
+            self._users.pop(user_id,None)
+
+    def __contains__(self, user_id:object) -> bool:
+        return user_id in self._ids
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._ids))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def loadedUsers(self) -> int:
+        return len(self._users)
+
+
+
+class ShardedStorage(Storage):
+    """One json file per user in usersPath (named after the user ID), each rewritten atomically
+    only when a batch of mutations touches that user. Loading just lists the directory:
+    every user is read from their file the first time it's accessed (see LazyUsers)
+
+    Attributes
+    -----
+    usersPath : str
+        The directory containing the users' files
+    """
+
+    usersPath:str
+
+    def __init__(self, usersPath:str, flushDelay:float=0.0) -> None:
+        super().__init__(flushDelay)
+        self.usersPath = usersPath
+        self.stats["usersRead"] = 0
+        self.stats["filesWritten"] = 0
+        if (not isdir(usersPath)): makedirs(usersPath,exist_ok=True)
+
+
+    def isEmpty(self) -> bool:
+        return not any(name.endswith(".json") for name in listdir(self.usersPath))
+
+    def importData(self, data:Dict[int,Dict[str,dict]]) -> None:
+        """Stores every user of data (e.g. read from the json database before switching backend)"""
+        self.updateUsers(data)
+        self.flush()
+
+    def getStats(self) -> Dict[str,float]:
+        stats = super().getStats()
+        if (isinstance(self.data,LazyUsers)): stats["usersLoaded"] = self.data.loadedUsers()
+        return stats
+
+
+    def _userPath(self, user_id:int) -> str:
+        return join(self.usersPath,f"{user_id}.json")
+
+    def _readUser(self, user_id:int) -> Dict[str,dict]:
+        self.stats["usersRead"] += 1
+        if (not isfile(self._userPath(user_id))): return {}
+        with open(self._userPath(user_id),"r",encoding='utf-8') as r_file:
+            return load(r_file,object_hook=internProduct)
+
+    def _read(self) -> LazyUsers:
+        user_ids = []
+        for name in listdir(self.usersPath):
+            if (not name.endswith(".json")): continue
+            try: user_ids.append(int(name[:-5]))
+            except ValueError: continue
+        return LazyUsers(user_ids,self._readUser)
+
+    def _write(self, records:List[dict]) -> None:
+        for user_id in {record["user"] for record in records}:
+            path = self._userPath(user_id)
+            if (user_id not in self.data):
+                if (isfile(path)): remove(path)
+                continue
+            with open(path+".tmp","w",encoding='utf-8') as w_file:
+                dump(self.data[user_id],w_file)
+                self.stats["bytesWritten"] += w_file.tell()
+            replace(path+".tmp",path)
+            self.stats["filesWritten"] += 1
+
+
+
+class SqliteStorage(Storage):
+    """The database in normalized SQLite tables (users, watchlists, products) in WAL mode,
+    every batch of mutations is a single transaction touching only the rows involved.
+    Other processes can read the file while it's being written (WAL), but this process must be
+    its only writer: the mirror is not refreshed from the file, and updateUser rewrites every
+    row of a user from it
+
+    Attributes
+    -----
+    dbPath : str
+        The filepath of the SQLite database
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS watchlists (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            targetPrice REAL,
+            lastTotal REAL,
+            total REAL NOT NULL,
+            pendingDiff REAL NOT NULL DEFAULT 0,
+            UNIQUE (user_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY,
+            watchlist_id INTEGER NOT NULL REFERENCES watchlists(id) ON DELETE CASCADE,
+            name TEXT,
+            fullName TEXT,
+            url TEXT NOT NULL,
+            asin TEXT,
+            lastPrice REAL,
+            price REAL
+        );
+        CREATE INDEX IF NOT EXISTS watchlists_name ON watchlists(name);
+        CREATE INDEX IF NOT EXISTS products_watchlist ON products(watchlist_id);
+        CREATE INDEX IF NOT EXISTS products_url ON products(url);
+    """
+
+    dbPath:str
+
+    def __init__(self, dbPath:str, flushDelay:float=0.0) -> None:
+        super().__init__(flushDelay)
+        self.stats.pop("bytesWritten")
+        self.stats["rowsWritten"] = 0
+        self.dbPath = dbPath
+        self._conn = sqlite3.connect(dbPath,timeout=30,check_same_thread=False,isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.SCHEMA)
+
+
+    def isEmpty(self) -> bool:
+        return self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def importData(self, data:Dict[int,Dict[str,dict]]) -> None:
+        """Stores every user of data (e.g. read from the json database before switching backend)"""
+        self.updateUsers(data)
+        self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock: self._conn.close()
+
+
+    def _read(self) -> Dict[int,Dict[str,dict]]:
+        data = {user_id:{} for user_id, in self._conn.execute("SELECT user_id FROM users")}
+        wls = {}
+        for wl_id,user_id,name,targetPrice,lastTotal,total,pendingDiff in self._conn.execute(
+            "SELECT id, user_id, name, targetPrice, lastTotal, total, pendingDiff FROM watchlists"
+        ):
+            wls[wl_id] = data.setdefault(user_id,{})[name] = {
+                "products":[],
+                "targetPrice":targetPrice,
+                "lastTotal":lastTotal,
+                "total":total,
+                "pendingDiff":pendingDiff
+            }
+        for wl_id,name,fullName,url,asin,lastPrice,price in self._conn.execute(
+            "SELECT watchlist_id, name, fullName, url, asin, lastPrice, price FROM products ORDER BY id"
+        ):
+            wls[wl_id]["products"].append(internProduct({"name":name,"fullName":fullName,"url":url,"asin":asin,"lastPrice":lastPrice,"price":price}))
+        return data
+
+    def _write(self, records:List[dict]) -> None:
+        changes = self._conn.total_changes
+        cur = self._conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for record in records: self._execute(cur,record)
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+        self.stats["rowsWritten"] += self._conn.total_changes-changes
+
+    def _execute(self, cur:sqlite3.Cursor, record:dict) -> None:
+        op,user_id = record["op"],record["user"]
+        if (op == "addUser"):
+            cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)",(user_id,))
+        elif (op == "removeUser"):
+            cur.execute("DELETE FROM users WHERE user_id = ?",(user_id,))
+        elif (op == "updateUser"):
+            cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)",(user_id,))
+            cur.execute("DELETE FROM watchlists WHERE user_id = ?",(user_id,))
+            for wl_name,wl_dict in record["watchlists"].items(): self._insertWatchlist(cur,user_id,wl_name,wl_dict)
+        elif (op == "addWatchlist"):
+            cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)",(user_id,))
+            self._insertWatchlist(cur,user_id,record["wl"],record["watchlist"])
+        elif (op == "removeWatchlist"):
+            cur.execute("DELETE FROM watchlists WHERE user_id = ? AND name = ?",(user_id,record["wl"]))
+        elif (op in ["addProduct","removeProduct"]):
+            wl_id, = cur.execute("SELECT id FROM watchlists WHERE user_id = ? AND name = ?",(user_id,record["wl"])).fetchone()
+            prod_d = record["product"]
+            if (op == "addProduct"): self._insertProducts(cur,wl_id,[prod_d])
+            else:
+                cur.execute(
+                    "DELETE FROM products WHERE id = (SELECT id FROM products WHERE watchlist_id = ? AND url = ? AND name IS ? LIMIT 1)",
+                    (wl_id,prod_d["url"],prod_d["name"])
+                )
+            cur.execute("UPDATE watchlists SET total = ? WHERE id = ?",(record["total"],wl_id))
+
+    def _insertWatchlist(self, cur:sqlite3.Cursor, user_id:int, wl_name:str, wl_dict:dict) -> None:
+        cur.execute(
+            "INSERT INTO watchlists (user_id, name, targetPrice, lastTotal, total, pendingDiff) VALUES (?,?,?,?,?,?)",
+            (user_id,wl_name,wl_dict["targetPrice"],wl_dict["lastTotal"],wl_dict["total"],wl_dict.get("pendingDiff",0.0))
+        )
+        self._insertProducts(cur,cur.lastrowid,wl_dict["products"])
+
+    def _insertProducts(self, cur:sqlite3.Cursor, wl_id:int, products:Iterable[dict]) -> None:
+        cur.executemany(
+            "INSERT INTO products (watchlist_id, name, fullName, url, asin, lastPrice, price) VALUES (?,?,?,?,?,?,?)",
+            [(wl_id,p["name"],p["fullName"],p["url"],p.get("asin",None),p["lastPrice"],p["price"]) for p in products]
+        )
+
+
+
+STORAGE_BACKENDS = ["json","journal","sharded","sqlite"]
+
+def openStorage(backend:str, jsonPath:str, sqlitePath:str, flushDelay:float=0.0) -> Storage:
+    """Returns the storage of the backend ("json", "journal", "sharded" or "sqlite"); a new SQLite
+    database or users directory (next to jsonPath) is filled with the content of the json database, if there's one
+    """
+    if (backend in ["sqlite","sharded"]):
+        if (backend == "sqlite"): storage = SqliteStorage(sqlitePath,flushDelay)
+        else: storage = ShardedStorage(join(dirname(jsonPath),"users"),flushDelay)
+        if (storage.isEmpty() and isfile(jsonPath)): storage.importData(JsonStorage(jsonPath).load())
+        return storage
+    if (backend == "json"): return JsonStorage(jsonPath,flushDelay)
+    if (backend == "journal"): return JournalStorage(jsonPath,splitext(jsonPath)[0]+".journal",flushDelay=flushDelay)
+    raise ValueError(f"Unknown storage backend {backend} (expected one of {', '.join(STORAGE_BACKENDS)})")
@@ -0,0 +1,66 @@
+from priceExtractor import extractFast, extractSoup
+from glob import glob
+from os.path import join, basename
+from time import time
+from sys import argv
+
+PAGES_PATH = "./tests/pages/"
+FILLER = b'<div class="a-section a-spacing-small"><span class="a-size-base">filler</span><script>var x = {"k":"v"};</script></div>\n'
+
+def loadPages(pages_path:str, padding_kb:int) -> dict:
+    """Loads the fixture pages, padding each one with filler markup (half before and half after
+    the product block) so that it weighs about as much as a real Amazon product page.
+    The fixtures are hand-written pages reproducing the markup of Amazon's product block, not captured pages
+    """
+    pages = {}
+    filler = FILLER * ((padding_kb*1024)//(2*len(FILLER)))
+    for path in sorted(glob(join(pages_path,"*.html"))):
+        with open(path,"rb") as page_file:
+            content = page_file.read()
+        head_cut = content.find(b"<body")
+        if (head_cut == -1): head_cut = 0
+        body_cut = content.rfind(b"</body>")
+        if (body_cut == -1): body_cut = len(content)
+        pages[basename(path)] = content[:head_cut] + filler + content[head_cut:body_cut] + filler + content[body_cut:]
+    return pages
+
+def timeExtractor(extractor, pages:dict, n_tests:int) -> float:
+    start = time()
+    for _ in range(n_tests):
+        for content in pages.values():
+            extractor(content)
+    return time() - start
+
+
+
+if (__name__ == "__main__"):
+
+    n_tests = 10
+    padding_kb = 1500
+    if (len(argv) > 1):
+        try:
+            n_tests = int(argv[1])
+        except:
+            print("Pass the number of runs as the first argument (integer)")
+            exit(0)
+    if (len(argv) > 2):
+        try:
+            padding_kb = int(argv[2])
+        except:
+            print("Pass the padding of each page in KB as the second argument (integer)")
+            exit(0)
+
+    pages = loadPages(PAGES_PATH,padding_kb)
+    mismatches = [name for name,content in pages.items() if extractFast(content) != extractSoup(content)]
+
+    print(f"Running {n_tests} runs on {len(pages)} pages (~{padding_kb} KB each)...\n")
+    soup_time = timeExtractor(extractSoup,pages,n_tests)
+    fast_time = timeExtractor(extractFast,pages,n_tests)
+    n_pages = n_tests*len(pages)
+
+    print(
+        f"BeautifulSoup: {soup_time:.3f} ({(soup_time/n_pages)*1000:.2f} ms/page)\n"
+        f"Fast extractor: {fast_time:.3f} ({(fast_time/n_pages)*1000:.2f} ms/page)\n"
+        f"Speedup: {(soup_time/fast_time):.1f}x\n"
+        f"Correctness = {len(pages)-len(mismatches)}/{len(pages)}" + (f" (mismatches: {', '.join(mismatches)})" if mismatches else "") + "\n"
+    )
@@ -0,0 +1,115 @@
+from AWSDatabase import AWSDatabase
+from storage import JsonStorage
+from test_timeStorage import makeUsers
+from tempfile import mkdtemp
+from os.path import join
+from shutil import rmtree
+from json import dump, load
+from time import perf_counter
+from sys import argv, getsizeof
+import tracemalloc
+import gc
+
+def loadGraph(jsonPath:str) -> tuple:
+    """Loads the database the way AWSDatabase does (storage mirror + live Watchlist/Product graph)
+    and returns the bytes allocated per product by each of the two, the bytes per product of the
+    graph taken by the indexes of the watchlists (sorted names, by name and by url) and the graph
+    """
+    gc.collect()
+    tracemalloc.start()
+    data = JsonStorage(jsonPath).load()
+    mirror,_ = tracemalloc.get_traced_memory()
+    users = {
+        user_id: {wl_name:AWSDatabase.Watchlist(wl_name,d=wl_d) for wl_name,wl_d in user_dict.items()}
+        for user_id,user_dict in data.items()
+    }
+    gc.collect()
+    total,_ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n_prods = sum(len(wl.products) for user_wls in users.values() for wl in user_wls.values())
+    indexes = sum(getsizeof(wl._keys)+getsizeof(wl._byName)+getsizeof(wl._byUrl) for user_wls in users.values() for wl in user_wls.values())
+    return mirror/n_prods,(total-mirror)/n_prods,indexes/n_prods,users
+
+class BaselineProduct:
+    """Product as it was before the slots: an instance with a __dict__, strings not interned"""
+
+    def __init__(self, d:dict) -> None:
+        self.url = d['url']
+        self.asin = d.get('asin',None)
+        self.name = d['name']
+        self.fullName = d['fullName']
+        self.lastPrice = d['lastPrice']
+        self.price = d['price']
+
+class BaselineWatchlist:
+    """Watchlist as it was before the slots (and before the indexes by name and url)"""
+
+    def __init__(self, name:str, d:dict) -> None:
+        self.name = name
+        self.products = [BaselineProduct(prod_d) for prod_d in d['products']]
+        self.targetPrice = d['targetPrice']
+        self.lastTotal = d['lastTotal']
+        self.total = d['total']
+        self.pendingDiff = d.get('pendingDiff',0.0)
+
+    def updateTotal(self) -> None:
+        diff = 0.0
+        for prod in self.products:
+            if (prod.lastPrice is not None): diff += prod.lastPrice - prod.price
+        self.lastTotal = self.total
+        self.total -= diff
+
+def loadBaseline(jsonPath:str) -> tuple:
+    """Same as loadGraph with the representation the database had before the slots:
+    the mirror read without interning and the graph made of BaselineWatchlist/BaselineProduct
+    """
+    gc.collect()
+    tracemalloc.start()
+    with open(jsonPath,"r",encoding='utf-8') as r_file:
+        data = load(r_file)
+    mirror,_ = tracemalloc.get_traced_memory()
+    users = {
+        user_id: {wl_name:BaselineWatchlist(wl_name,wl_d) for wl_name,wl_d in user_dict.items()}
+        for user_id,user_dict in data.items()
+    }
+    gc.collect()
+    total,_ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    n_prods = sum(len(wl.products) for user_wls in users.values() for wl in user_wls.values())
+    return mirror/n_prods,(total-mirror)/n_prods,users
+
+def updateTotals(users:dict, rounds:int=10) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        for user_wls in users.values():
+            for wl in user_wls.values(): wl.updateTotal()
+    return perf_counter()-start
+
+
+if (__name__ == "__main__"):
+
+    n_users = 1000
+    if (len(argv) > 1):
+        try:
+            n_users = int(argv[1])
+        except:
+            print("Pass the number of users as the first argument (integer)")
+            exit(0)
+
+    # every user tracks the same 15 products, as it happens with popular items
+    users = {user_id:user_dict for user_id,user_dict in enumerate(makeUsers(1,3,5)[0] for _ in range(n_users))}
+    path = mkdtemp()
+    with open(join(path,"database.json"),"w",encoding='utf-8') as w_file: dump(users,w_file)
+    print(f"{n_users} users, 3 watchlists of 5 products each ({n_users*15} products)\n")
+    mirror,graph,graph_users = loadBaseline(join(path,"database.json"))
+    print(
+        f"Baseline (instance dictionaries): storage mirror {mirror:.0f} B/product, live graph {graph:.0f} B/product, "
+        f"10 rounds of totals {updateTotals(graph_users):.3f} s"
+    )
+    del graph_users
+    mirror,graph,indexes,graph_users = loadGraph(join(path,"database.json"))
+    print(
+        f"Slots and interned strings: storage mirror {mirror:.0f} B/product, live graph {graph:.0f} B/product "
+        f"({graph-indexes:.0f} without the watchlist indexes), 10 rounds of totals {updateTotals(graph_users):.3f} s"
+    )
+    rmtree(path)
@@ -1,49 +1,160 @@
-from AWSDatabase import AWSDatabase
-from dotenv import load_dotenv
-from os import getenv
+from priceExtractor import extractPriceTitle, isBlockPage, IncrementalExtractor, ExtractorChain, EXTRACTOR_CHAIN, pageFingerprint, findSpan
+from parsePool import ParsePool
+from concurrent.futures import ThreadPoolExecutor
+from os import cpu_count
+from test_timeExtractor import loadPages
 from os.path import join
 from json import load
-from time import time
+from time import perf_counter, sleep
+from threading import Event, Thread
+from sys import argv
 
-def getProducts(json_path:str) -> list:
-    prods = []
+PAGES_PATH = "./tests/pages/"
+EXPECTED_PATH = join(PAGES_PATH,"expected.json")
+CHUNK_SIZE = 65536
+
+def getExpected(json_path:str) -> dict:
     with open(json_path,"r",encoding='utf-8') as in_json:
-        prods = list(dict(load(in_json)).get("products"))
-    return prods
-
-TEST_PATH = "./tests/"
-TEST_WL_NAME = "Test Watchlist"
-TESTS = 10
-
-load_dotenv()
-test_db = AWSDatabase(getenv("ADMIN_ID"),TEST_PATH)
-
-test_products = getProducts(join(TEST_PATH,"test_products.json"))
-test_db.addWatchlist(test_db.adminId,TEST_WL_NAME)
-error_count = 0
-
-print(f"Running {TESTS} tests...\n")
-start = time()
-for _ in range(TESTS):
-    for prod in test_products:
-        url = prod[1]
-        name = prod[0]
-        added_name = test_db.addProduct(test_db.adminId,TEST_WL_NAME,url,name)
-        if (added_name is None):
-            error_count += 1
-            print(f"Error #{error_count}: [{name},{url}]")
-        else: print(f"~> {added_name} added to watchlist")
-elapsed = time()-start
-
-
-list_str = ""
-for prod_name in test_db.getProducts(test_db.adminId,TEST_WL_NAME):
-    list_str += f"\t{prod_name}\n"
-out_str = (
-        f"Stats for the parsing of {len(test_products)} products:\n"
-        f"Average time = {(elapsed/TESTS):.3f} ({((elapsed/TESTS)/len(test_products)):.3f}/product)\n"
-        f"Correctness = {TESTS-error_count}/{TESTS}\n"
-        f"Product list = [\n{list_str}]"
+        return dict(load(in_json))
+
+def parsePage(content:bytes, stream:bool) -> dict:
+    """Runs the same extraction steps webScrape runs on a downloaded page (block check, then price and title),
+    feeding the page in CHUNK_SIZE chunks when stream is True, without any network, retry or throttling
+    """
+    if (stream):
+        extractor = IncrementalExtractor()
+        for i in range(0,len(content),CHUNK_SIZE):
+            if (extractor.feed(content[i:i+CHUNK_SIZE])): break
+        if (extractor.blocked): return {"price":None,"title":None,"blocked":True}
+        price,title,_ = extractor.result()
+    else:
+        if (isBlockPage(content)): return {"price":None,"title":None,"blocked":True}
+        price,title = extractPriceTitle(content)
+    return {"price":price,"title":title,"blocked":False}
+
+def stalePriceFingerprints(pages:dict) -> list:
+    """Changes the first digit of the price of every page that has a fingerprint and returns the pages
+    whose fingerprint stays the same (an IncrementalExtractor would report them unchanged and keep the old price)
+    """
+    stale = []
+    for name,content in pages.items():
+        fingerprint = pageFingerprint(content)
+        if (fingerprint is None): continue
+        pos,_ = findSpan(content,b"class",b"a-price-whole")
+        changed = content[:pos] + (b"2" if content[pos:pos+1] != b"2" else b"3") + content[pos+1:]
+        extractor = IncrementalExtractor(fingerprint)
+        for i in range(0,len(changed),CHUNK_SIZE):
+            if (extractor.feed(changed[i:i+CHUNK_SIZE])): break
+        if ((pageFingerprint(changed) == fingerprint) or extractor.unchanged): stale.append(name)
+    return stale
+
+def reorderedMismatches(pages:dict, expected:dict) -> list:
+    """Extracts the pages with a chain reordered after stats in which corePrice is the cheapest strategy
+    with the best hit rate and spans the slowest one that never hits, and returns the pages whose
+    (price, title) differs from the expected one (the result must not depend on the stats of other pages)
+    """
+    chain = ExtractorChain(reorderEvery=0)
+    chain.record([("corePrice",0.0,True)]*100 + [("spans",1.0,False)]*100)
+    chain.reorder()
+    return [
+        name for name,content in pages.items()
+        if ((not expected[name]["blocked"]) and (chain.extract(content)[:2] != (expected[name]["price"],expected[name]["title"])))
+    ]
+
+def percentile(samples:list, p:float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered)-1,int(round((p/100)*(len(ordered)-1))))]
+
+def timeParser(pages:dict, n_tests:int, stream:bool) -> tuple:
+    latencies = []
+    results = {}
+    start = perf_counter()
+    for _ in range(n_tests):
+        for name,content in pages.items():
+            page_start = perf_counter()
+            results[name] = parsePage(content,stream)
+            latencies.append(perf_counter()-page_start)
+    return perf_counter()-start,latencies,results
+
+
+
+if (__name__ == "__main__"):
+
+    n_tests = 10
+    padding_kb = 1500
+    if (len(argv) > 1):
+        try:
+            n_tests = int(argv[1])
+        except:
+            print("Pass the number of runs as the first argument (integer)")
+            exit(0)
+    if (len(argv) > 2):
+        try:
+            padding_kb = int(argv[2])
+        except:
+            print("Pass the padding of each page in KB as the second argument (integer)")
+            exit(0)
+
+    pages = loadPages(PAGES_PATH,padding_kb)
+    expected = getExpected(EXPECTED_PATH)
+    pages = {name:content for name,content in pages.items() if name in expected}
+
+    print(f"Running {n_tests} runs on {len(pages)} pages (~{padding_kb} KB each), fully offline...\n")
+    for stream in [False,True]:
+        elapsed,latencies,results = timeParser(pages,n_tests,stream)
+        mismatches = [name for name,result in results.items() if result != expected[name]]
+        print(
+            f"{'Streamed' if stream else 'Whole page'} extraction:\n"
+            f"Total time = {elapsed:.3f} s\n"
+            f"Latency p50 = {percentile(latencies,50)*1000:.2f} ms, p90 = {percentile(latencies,90)*1000:.2f} ms, p99 = {percentile(latencies,99)*1000:.2f} ms\n"
+            f"Throughput = {len(latencies)/elapsed:.1f} pages/s\n"
+            f"Correctness = {len(pages)-len(mismatches)}/{len(pages)}" + (f" (mismatches: {', '.join(mismatches)})" if mismatches else "") + "\n"
+        )
+        for name in mismatches:
+            print(f"\t{name}: expected {expected[name]}, got {results[name]}")
+
+    fingerprinted = [name for name,content in pages.items() if pageFingerprint(content) is not None]
+    stale = stalePriceFingerprints(pages)
+    print(
+        f"Fingerprints changed by a price change = {len(fingerprinted)-len(stale)}/{len(fingerprinted)}"
+        + (f" (unchanged: {', '.join(stale)})" if stale else "") + "\n"
+    )
+
+    reordered = reorderedMismatches(pages,expected)
+    print(
+        f"Correctness after a reorder that favours corePrice = {len(pages)-len(reordered)}/{len(pages)}"
+        + (f" (mismatches: {', '.join(reordered)})" if reordered else "") + "\n"
     )
+    assert len(reordered) == 0, f"the extracted prices depend on the order of the strategies: {', '.join(reordered)}"
+
+    # whole pages parsed by concurrent fetch threads, in the threads themselves and then in the parse pool,
+    # while another thread (like the bot's handlers) measures how late its 10 ms ticks are
+    jobs = [content for _ in range(n_tests) for content in pages.values()]
+    for workers in [0,cpu_count() or 1]:
+        parser = ParsePool(workers)
+        parser.start()
+        lags = []
+        done = Event()
+        def tick() -> None:
+            while (not done.is_set()):
+                tick_start = perf_counter()
+                sleep(0.01)
+                lags.append(perf_counter()-tick_start-0.01)
+        ticker = Thread(target=tick)
+        ticker.start()
+        start = perf_counter()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda content: (isBlockPage(content) or parser.parse(content)),jobs))
+        elapsed = perf_counter()-start
+        done.set()
+        ticker.join()
+        parser.shutdown()
+        print(
+            f"{'Fetch threads' if workers == 0 else f'Parse pool ({workers} processes)'}: {len(jobs)/elapsed:.1f} pages/s, "
+            f"handler lag p50 = {percentile(lags,50)*1000:.2f} ms, max = {max(lags)*1000:.2f} ms"
+        )
+    print()
 
-print(out_str)
\ No newline at end of file
+    print("Extraction strategies (current order):")
+    for name,strategy_stats in EXTRACTOR_CHAIN.getStats().items():
+        print(f"\t{name}: " + ", ".join(f"{key}={value}" for key,value in strategy_stats.items()))
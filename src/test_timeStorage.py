@@ -0,0 +1,127 @@
+from storage import openStorage, STORAGE_BACKENDS
+from AWSDatabase import AWSDatabase
+from tempfile import mkdtemp
+from os.path import join
+from shutil import rmtree
+from time import perf_counter, time
+from sys import argv
+
+PAGES_PATH = "./tests/pages/"
+
+def makeUsers(n_users:int, n_wls:int, n_prods:int) -> dict:
+    return {
+        user_id: {
+            f"wl{w}": {
+                "products": [
+                    {"name":None,"fullName":f"Product {p} of watchlist {w}","url":f"https://www.amazon.it/dp/B0{user_id:04d}{w:02d}{p:02d}","asin":f"B0{user_id:04d}{w:02d}{p:02d}","lastPrice":10.0,"price":10.0}
+                    for p in range(n_prods)
+                ],
+                "targetPrice":None,"lastTotal":None,"total":10.0*n_prods,"pendingDiff":0.0
+            } for w in range(n_wls)
+        } for user_id in range(n_users)
+    }
+
+class OfflineSession:
+    """Answers every request with the same saved page, so that an update cycle runs without any network"""
+
+    class Response:
+        def __init__(self, content:bytes) -> None:
+            self.status_code = 200
+            self.headers = {}
+            self.content = content
+
+    def __init__(self, pagePath:str) -> None:
+        with open(pagePath,"rb") as page_file:
+            self.page = page_file.read()
+
+    def get(self, url:str, **kwargs) -> Response:
+        return self.Response(self.page)
+
+    def getStream(self, url:str, feed, **kwargs) -> Response:
+        feed(self.page)
+        return self.Response(self.page)
+
+def pollCycleWrites(n_users:int) -> dict:
+    """A poll tick (updateAllWatchlists with dueOnly) of AWSDatabase on the sharded backend in which
+    a single product of a single user is due, returns the storage counters of the tick
+    """
+    path = mkdtemp()
+    users = makeUsers(n_users,3,5)
+    storage = openStorage("sharded",join(path,"database.json"),join(path,"database.sqlite3"))
+    storage.importData(users)
+    storage.close()
+    with open(join(path,"authorized_users.csv"),"w",encoding='utf-8') as w_file:
+        w_file.write("user_id,user_firstName,role\n" + "".join(f"{user_id},user{user_id},User\n" for user_id in users))
+    db = AWSDatabase(-1,path,storageBackend="sharded")
+    db.scraper.session = OfflineSession(join(PAGES_PATH,"it_standard.html"))
+    # every product was checked two hours ago (out of the hourly budget, not due yet) except one, whose check is long overdue
+    due_key = users[0]["wl0"]["products"][0]["url"]
+    checked = time()-7200
+    for user_dict in users.values():
+        for wl_dict in user_dict.values():
+            for prod_d in wl_dict["products"]: db.pollScheduler.observe(prod_d["url"],prod_d["price"],now=(0.0 if prod_d["url"] == due_key else checked))
+    start_stats = db.storage.getStats()
+    db.updateAllWatchlists(list(users),dueOnly=True)
+    end_stats = db.storage.getStats()
+    db.storage.close()
+    rmtree(path)
+    return {key:end_stats[key]-start_stats[key] for key in ["mutations","writes","filesWritten","bytesWritten"]}
+
+def runCycle(backend:str, users:dict, flushDelay:float, batched:bool) -> tuple:
+    """An update cycle (every user's prices rewritten) followed by 100 interactive commands,
+    the way AWSDatabase persisted them before (one write per user and per command, flushDelay 0)
+    or with the debounce window and the whole cycle in one batch
+    """
+    path = mkdtemp()
+    storage = openStorage(backend,join(path,"database.json"),join(path,"database.sqlite3"),flushDelay)
+    storage.load()
+    storage.updateUsers(users)
+    storage.flush()
+    start_stats = storage.getStats()
+    start = perf_counter()
+    if (batched):
+        with storage.batch():
+            for user_id,user_dict in users.items(): storage.updateUsers({user_id:user_dict})
+    else:
+        for user_id,user_dict in users.items(): storage.updateUsers({user_id:user_dict})
+    for i in range(100):
+        user_id = i % len(users)
+        storage.addWatchlist(user_id,f"new{i}",{"products":[],"targetPrice":None,"lastTotal":None,"total":0.0,"pendingDiff":0.0})
+        storage.removeWatchlist(user_id,f"new{i}")
+    storage.flush()
+    elapsed = perf_counter()-start
+    end_stats = storage.getStats()
+    storage.close()
+    rmtree(path)
+    return elapsed,{key:end_stats[key]-start_stats[key] for key in ["mutations","coalesced","writes","bytesWritten","rowsWritten"] if key in end_stats}
+
+
+
+if (__name__ == "__main__"):
+
+    n_users = 200
+    if (len(argv) > 1):
+        try:
+            n_users = int(argv[1])
+        except:
+            print("Pass the number of users as the first argument (integer)")
+            exit(0)
+
+    users = makeUsers(n_users,3,5)
+    print(f"Update cycle of {n_users} users (3 watchlists of 5 products each) + 100 interactive commands\n")
+    for backend in STORAGE_BACKENDS:
+        for flushDelay,batched in [(0.0,False),(1.0,True)]:
+            elapsed,stats = runCycle(backend,users,flushDelay,batched)
+            written = f"{stats['bytesWritten']/1024:.0f} KB" if "bytesWritten" in stats else f"{stats['rowsWritten']} rows"
+            print(
+                f"{backend} ({'debounced, batched cycle' if batched else 'write-through'}): {elapsed:.3f} s, "
+                f"{stats['mutations']} mutations, {stats['writes']} writes, {stats['coalesced']} coalesced, {written} written"
+            )
+        print()
+
+    stats = pollCycleWrites(n_users)
+    print(
+        f"Poll tick with 1 due product (sharded): {stats['mutations']} mutations, {stats['filesWritten']} user files written, "
+        f"{stats['bytesWritten']/1024:.1f} KB written"
+    )
+    assert stats["filesWritten"] == 1, f"a poll tick that scrapes one product should rewrite only its user's file, {stats['filesWritten']} were written"
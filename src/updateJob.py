@@ -0,0 +1,182 @@
+from json import load,dump,loads,dumps
+from os import replace,fsync
+from os.path import isfile,splitext
+from threading import Lock
+from typing import Dict, List, Tuple, Union
+
+
+
+class UpdateJob:
+    """Persistent checkpoint of the daily update cycle in progress, so that a restart resumes it
+    where it left off instead of scraping everything again or notifying users twice
+
+    A cycle is identified by the date of the notification it leads to. Every change is written
+    to disk right away: the scraped products and the notified users are appended to a log,
+    the other changes rewrite jsonPath (to a temporary file, synced to disk before it replaces it, so that
+    neither a crash nor a power loss leaves a truncated checkpoint) with everything the log holds and
+    start the log over, so that each product is written a bounded number of times per cycle.
+    The notified users are synced to disk as soon as they're appended, a lost product is only scraped again
+
+    Attributes
+    -----
+    jsonPath : str
+        The filepath of the json file containing the checkpoint
+
+    logPath : str
+        The filepath of the log of the changes made since jsonPath was written
+
+    cycle : Union[str,None]
+        The cycle in progress (or the last one), None if no cycle has ever started
+
+    shardsDone : List[int]
+        The shards of the cycle whose update has completed
+
+    products : Dict[str,Union[list,str]]
+        Product key -> [fullName, price] of the products already scraped in the cycle,
+        or the name of the exception that made the product unfit for scraping
+
+    messages : Dict[str,str]
+        User ID -> consolidated notification, once the notification has been built
+
+    notifiedUsers : List[int]
+        The users whose notification has been sent
+
+    finished : bool
+        Whether every user of the cycle has been notified
+
+    Methods
+    -----
+    begin(cycle:str) -> None
+        Makes cycle the one in progress, starting from scratch if it's not the current one
+
+    productDone(key:str, outcome:Union[Tuple[str,float],str]) -> None
+        Checkpoints the result of a product, (fullName, price) or the exception name
+
+    getProduct(key:str) -> Union[list,str,None]
+        Returns the checkpointed result of a product, None if it hasn't been scraped in the cycle
+
+    shardDone(shard:int) -> None
+        Checkpoints a completed shard
+
+    setMessages(messages:Dict[int,str]) -> None
+        Checkpoints the consolidated notifications before they're sent
+
+    userNotified(user_id:int) -> None
+        Checkpoints a sent notification
+
+    finish() -> None
+        Marks the cycle as completed
+    """
+
+    jsonPath:Union[str,None]
+    logPath:Union[str,None]
+    cycle:Union[str,None]
+    shardsDone:List[int]
+    products:Dict[str,Union[list,str]]
+    messages:Dict[str,str]
+    notifiedUsers:List[int]
+    finished:bool
+
+    def __init__(self, jsonPath:str=None) -> None:
+        self.jsonPath = jsonPath
+        self.logPath = (splitext(jsonPath)[0]+".log") if jsonPath is not None else None
+        self.cycle = None
+        self.reset()
+        self._lock = Lock()
+        self._log = None
+        if ((jsonPath is not None) and isfile(jsonPath)): self.loadJob()
+
+    def reset(self) -> None:
+        self.shardsDone = []
+        self.products = {}
+        self.messages = {}
+        self.notifiedUsers = []
+        self.finished = False
+
+
+    def begin(self, cycle:str) -> None:
+        with self._lock:
+            if (self.cycle == cycle): return
+            self.cycle = cycle
+            self.reset()
+            self._save()
+
+    def productDone(self, key:str, outcome:Union[Tuple[str,float],str]) -> None:
+        with self._lock:
+            self.products[key] = list(outcome) if isinstance(outcome,tuple) else outcome
+            self._append({"product":key,"outcome":self.products[key]})
+
+    def getProduct(self, key:str) -> Union[list,str,None]:
+        with self._lock: return self.products.get(key,None)
+
+    def shardDone(self, shard:int) -> None:
+        with self._lock:
+            if (shard not in self.shardsDone): self.shardsDone.append(shard)
+            self._save()
+
+    def setMessages(self, messages:Dict[int,str]) -> None:
+        with self._lock:
+            self.messages = {str(user_id):msg for user_id,msg in messages.items()}
+            self._save()
+
+    def userNotified(self, user_id:int) -> None:
+        with self._lock:
+            if (user_id in self.notifiedUsers): return
+            self.notifiedUsers.append(user_id)
+            # synced: a user notified again after a power loss would get the message twice
+            self._append({"notified":user_id},sync=True)
+
+    def finish(self) -> None:
+        with self._lock:
+            self.finished = True
+            self._save()
+
+
+    def loadJob(self) -> None:
+        """Reads the checkpoint from the json file at jsonPath"""
+        with open(self.jsonPath,"r",encoding='utf-8') as r_file:
+            tmp_d = load(r_file)
+        self.cycle = tmp_d.get("cycle",None)
+        self.shardsDone = tmp_d.get("shardsDone",[])
+        self.products = tmp_d.get("products",{})
+        self.messages = tmp_d.get("messages",{})
+        self.notifiedUsers = tmp_d.get("notifiedUsers",[])
+        self.finished = tmp_d.get("finished",False)
+        if (not isfile(self.logPath)): return
+        valid = 0
+        with open(self.logPath,"rb") as r_file:
+            for line in r_file:
+                try: record = loads(line)
+                except ValueError: break
+                valid += len(line)
+                # records of another cycle are left by a crash during begin
+                if (record.get("cycle",None) != self.cycle): continue
+                if ("product" in record): self.products[record["product"]] = record["outcome"]
+                elif (record["notified"] not in self.notifiedUsers): self.notifiedUsers.append(record["notified"])
+        # a line cut by a crash is dropped, so that the next records aren't appended after it
+        with open(self.logPath,"r+b") as w_file: w_file.truncate(valid)
+
+    def _save(self) -> None:
+        if (self.jsonPath is None): return
+        with open(self.jsonPath+".tmp","w",encoding='utf-8') as w_file:
+            dump({
+                "cycle": self.cycle,
+                "shardsDone": self.shardsDone,
+                "products": self.products,
+                "messages": self.messages,
+                "notifiedUsers": self.notifiedUsers,
+                "finished": self.finished
+            },w_file)
+            w_file.flush()
+            fsync(w_file.fileno())
+        replace(self.jsonPath+".tmp",self.jsonPath)
+        # jsonPath now holds every record of the log
+        if (self._log is not None): self._log.close()
+        self._log = open(self.logPath,"w",encoding='utf-8')
+
+    def _append(self, record:dict, sync:bool=False) -> None:
+        if (self.jsonPath is None): return
+        if (self._log is None): self._log = open(self.logPath,"a",encoding='utf-8')
+        self._log.write(dumps({**record,"cycle":self.cycle},separators=(",",":"))+"\n")
+        self._log.flush()
+        if (sync): fsync(self._log.fileno())